@@ -1,32 +1,204 @@
-from flask import Flask, render_template_string, request, jsonify
+from flask import Flask, render_template_string, request, jsonify, g, Response, send_file
 import pandas as pd
+from pandas.api.types import union_categoricals
 import numpy as np
 import os
+import importlib.util
+import re
+import shutil
+import time
 import uuid
+import tempfile
+import zipfile
+import multiprocessing
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+import json
+import hashlib
+import math
+import base64
+import io
+import sqlite3
+import cProfile
+import threading
+from collections import OrderedDict, Counter
+from contextlib import contextmanager, closing
+from functools import partial, reduce
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+try:
+    import openpyxl
+except ImportError:
+    openpyxl = None
 import matplotlib
 matplotlib.use('Agg')
-import matplotlib.pyplot as plt
-import seaborn as sns
+from matplotlib.figure import Figure
+from matplotlib.patches import Patch
 from datetime import datetime
 
 app = Flask(__name__)
 app.config['UPLOAD_FOLDER'] = 'static/uploads'
+app.config['CSV_CHUNK_SIZE'] = 100000
+app.config['CSV_ENGINE'] = 'c'
+app.config['DATE_FORMAT'] = '%Y-%m-%d'
+app.config['EXCEL_ENGINE'] = 'calamine'
+app.config['EXCEL_SHEET'] = 0
+app.config['RESULT_CACHE_MAX_BYTES'] = 256 * 1024 * 1024
+app.config['JOB_FOLDER'] = os.path.join(tempfile.gettempdir(), 'blood_type_jobs')
+app.config['JOB_WORKERS'] = 2
+app.config['JOB_QUEUE_LIMIT'] = 32
+app.config['JOB_HISTORY'] = 1000
+app.config['CHART_WORKERS'] = 4
+app.config['SHARD_WORKERS'] = os.cpu_count() or 1
+app.config['CHART_RENDERER'] = 'summary'
+app.config['CHART_DELIVERY'] = 'lazy'
+app.config['CHART_SUMMARY_CACHE'] = 64
+app.config['CHART_STORAGE'] = 'disk'
+app.config['ARTIFACT_INDEX'] = None
+app.config['ARTIFACT_MAX_BYTES'] = 1024 * 1024 * 1024
+app.config['ARTIFACT_MAX_AGE'] = 7 * 24 * 3600
+app.config['ARTIFACT_MEMORY_BYTES'] = 64 * 1024 * 1024
+app.config['STATS_RESAMPLES'] = 1000
+app.config['STATS_SEED'] = 0
+app.config['STATS_THREADS'] = os.cpu_count() or 1
+app.config['STATS_CONFIDENCE'] = 0.95
+app.config['STATS_CORRECTION'] = 'holm'
+app.config['STATS_MIN_COUNT'] = 10
+app.config['STATS_BLOCK_ELEMENTS'] = 4 * 1024 * 1024
+app.config['TREND_CACHE_BYTES'] = 512 * 1024 * 1024
+app.config['QUERY_INDEX_CACHE_BYTES'] = 512 * 1024 * 1024
+app.config['DATASET_FOLDER'] = 'datasets'
+app.config['DATASET_STORE'] = True
+app.config['DATASET_MAX_BYTES'] = 10 * 1024 * 1024 * 1024
+app.config['DATASET_MAX_AGE'] = 30 * 24 * 3600
+app.config['METRICS_BUCKETS'] = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+app.config['PROFILE_REQUESTS'] = False
+app.config['MAX_CONTENT_LENGTH'] = None
+app.config['BATCH_MAX_EXTRACTED_BYTES'] = 2 * 1024 * 1024 * 1024
+app.config['MAX_CONCURRENT_REQUESTS'] = None
+app.config['PROFILE_FOLDER'] = 'profiles'
+app.config['METRICS_FOLDER'] = None
 os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
+os.makedirs(app.config['JOB_FOLDER'], exist_ok=True)
+os.makedirs(app.config['DATASET_FOLDER'], exist_ok=True)
 
-def analyze_data(df):
+BLOOD_TYPES = ['A+', 'A-', 'B+', 'B-', 'AB+', 'AB-', 'O+', 'O-']
+SUPPORTED_EXTENSIONS = ('.csv', '.xls', '.xlsx')
+REQUIRED_COLUMNS = ['PatientID', 'BloodType', 'Diagnosis', 'AdmissionDate', 'DischargeDate']
+CATEGORICAL_COLUMNS = ['BloodType', 'Diagnosis']
+DATE_COLUMNS = ['AdmissionDate', 'DischargeDate']
+ANALYSIS_COLUMNS = CATEGORICAL_COLUMNS + DATE_COLUMNS
+# Patient IDs are text: pandas would otherwise infer int or float per file, and 1 and 1.0 must match '1'.
+CSV_DTYPES = dict({col: 'category' for col in CATEGORICAL_COLUMNS + DATE_COLUMNS}, PatientID=str)
+ANALYSIS_VERSION = '1'
+CHART_NAMES = ['blood_type', 'blood_diagnosis', 'histogram', 'pie']
+CHART_FORMATS = {'png': 'image/png', 'svg': 'image/svg+xml', 'webp': 'image/webp'}
+
+class StageMetrics:
+    # With METRICS_FOLDER set, every process (server workers and their pool processes) writes its
+    # histograms to its own file there, and /metrics in any worker renders the sum of all files.
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.reset()
+        os.register_at_fork(after_in_child=self.reset)
+
+    def reset(self):
+        # A forked child starts empty instead of exporting its parent's observations a second time.
+        self.stages = {}
+        self.lock = threading.Lock()
+        self.name = f'{os.getpid()}-{uuid.uuid4().hex[:8]}.json'
+        self.flushed = 0
+
+    def observe(self, name, seconds, rows=None):
+        with self.lock:
+            entry = self.stages.setdefault(name, {'buckets': [0] * len(self.buckets), 'count': 0, 'sum': 0.0, 'rows': 0})
+            for i, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    entry['buckets'][i] += 1
+            entry['count'] += 1
+            entry['sum'] += seconds
+            entry['rows'] += rows or 0
+        if time.monotonic() - self.flushed > 1:
+            self.flush()
+
+    def snapshot(self):
+        with self.lock:
+            return {name: dict(entry, buckets=list(entry['buckets'])) for name, entry in self.stages.items()}
+
+    def flush(self):
+        folder = app.config['METRICS_FOLDER']
+        if folder:
+            self.flushed = time.monotonic()
+            write_file(os.path.join(folder, self.name), json.dumps(self.snapshot()))
+
+    def collect(self):
+        folder = app.config['METRICS_FOLDER']
+        if not folder:
+            return self.snapshot()
+        self.flush()
+        stages = {}
+        for name in os.listdir(folder):
+            if not name.endswith('.json'):
+                continue
+            try:
+                with open(os.path.join(folder, name)) as f:
+                    process = json.load(f)
+            except (OSError, ValueError):
+                continue
+            for stage_name, entry in process.items():
+                total = stages.setdefault(stage_name, {'buckets': [0] * len(self.buckets), 'count': 0, 'sum': 0.0, 'rows': 0})
+                total['buckets'] = [a + b for a, b in zip(total['buckets'], entry['buckets'])]
+                for key in ('count', 'sum', 'rows'):
+                    total[key] += entry[key]
+        return stages
+
+    def render(self):
+        lines = [
+            '# HELP blood_type_stage_seconds Time spent in each pipeline stage.',
+            '# TYPE blood_type_stage_seconds histogram'
+        ]
+        stages = dict(sorted(self.collect().items()))
+        for name, entry in stages.items():
+            for bound, count in zip(self.buckets, entry['buckets']):
+                lines.append(f'blood_type_stage_seconds_bucket{{stage="{name}",le="{bound}"}} {count}')
+            lines.append(f'blood_type_stage_seconds_bucket{{stage="{name}",le="+Inf"}} {entry["count"]}')
+            lines.append(f'blood_type_stage_seconds_sum{{stage="{name}"}} {entry["sum"]:.6f}')
+            lines.append(f'blood_type_stage_seconds_count{{stage="{name}"}} {entry["count"]}')
+        lines.append('# HELP blood_type_stage_rows_total Rows processed by each pipeline stage.')
+        lines.append('# TYPE blood_type_stage_rows_total counter')
+        for name, entry in stages.items():
+            lines.append(f'blood_type_stage_rows_total{{stage="{name}"}} {entry["rows"]}')
+        return '\n'.join(lines) + '\n'
+
+stage_metrics = StageMetrics(app.config['METRICS_BUCKETS'])
+
+@contextmanager
+def stage(name, rows=None):
+    span = {'rows': rows}
+    started = time.perf_counter()
+    try:
+        yield span
+    finally:
+        stage_metrics.observe(name, time.perf_counter() - started, span['rows'])
+
+def encode_labels(values, fixed_levels=()):
+    values = values.astype('category')
+    levels = list(fixed_levels) + sorted(set(values.cat.categories) - set(fixed_levels))
+    lookup = np.append(pd.Index(levels).get_indexer(values.cat.categories), len(levels)).astype(
+        np.int8 if len(levels) < 127 else np.int32)
+    # Missing labels map to the extra slot len(levels) so they still count towards the totals.
+    return lookup[values.cat.codes.to_numpy()], levels
+
+def format_results(total_patients, values, counts, blood_type_stats, diagnosis_stats, blood_diagnosis, monthly_trend):
     results = {}
-    df['AdmissionDate'] = pd.to_datetime(df['AdmissionDate'])
-    df['DischargeDate'] = pd.to_datetime(df['DischargeDate'])
-    df['LengthOfStay'] = (df['DischargeDate'] - df['AdmissionDate']).dt.days
+    results['total_patients'] = int(total_patients)
+    results['avg_stay'] = float(round((values * counts).sum() / counts.sum(), 2))
+    results['median_stay'] = float(round(float(weighted_quantile(values, counts, 0.5)), 2))
+    results['max_stay'] = int(values[counts > 0].max())
+    results['min_stay'] = int(values[counts > 0].min())
     
-    
-    results['total_patients'] = int(len(df))
-    results['avg_stay'] = float(round(df['LengthOfStay'].mean(), 2))
-    results['median_stay'] = float(round(df['LengthOfStay'].median(), 2))
-    results['max_stay'] = int(df['LengthOfStay'].max())
-    results['min_stay'] = int(df['LengthOfStay'].min())
-    
-    blood_type_stats = df.groupby('BloodType')['LengthOfStay'].agg(['mean', 'count', 'median'])
+    blood_type_stats = blood_type_stats.sort_index()
     blood_type_stats['mean'] = blood_type_stats['mean'].round(2)
     blood_type_stats['median'] = blood_type_stats['median'].round(2)
     results['blood_type_stats'] = {
@@ -35,67 +207,1768 @@ def analyze_data(df):
         'median': blood_type_stats['median'].astype(float).to_dict()
     }
     
-    diagnosis_stats = df.groupby('Diagnosis')['LengthOfStay'].agg(['mean', 'count'])
+    diagnosis_stats = diagnosis_stats.sort_index()
     diagnosis_stats['mean'] = diagnosis_stats['mean'].round(2)
     results['diagnosis_stats'] = {
         'mean': diagnosis_stats.sort_values('count', ascending=False).head(10)['mean'].astype(float).to_dict(),
         'count': diagnosis_stats.sort_values('count', ascending=False).head(10)['count'].astype(int).to_dict()
     }
     
-    blood_diagnosis = df.groupby(['BloodType', 'Diagnosis'])['LengthOfStay'].mean().unstack()
+    blood_diagnosis = blood_diagnosis.sort_index().sort_index(axis=1)
     results['blood_diagnosis_matrix'] = blood_diagnosis.round(2).fillna('-').astype(object).to_dict()
     
-    monthly_trend = df.groupby(df['AdmissionDate'].dt.to_period('M')).size()
-    results['monthly_trend'] = {str(k): int(v) for k, v in monthly_trend.items()}
-    
+    results['monthly_trend'] = {str(k): int(v) for k, v in monthly_trend.sort_index().items()}
     return results
 
-def generate_visualizations(df, file_prefix):
-    plots = {}
+def analyze_data(df):
+    with stage('analyze.dates', len(df)):
+        df['AdmissionDate'] = pd.to_datetime(df['AdmissionDate'])
+        df['DischargeDate'] = pd.to_datetime(df['DischargeDate'])
+        df['LengthOfStay'] = (df['DischargeDate'] - df['AdmissionDate']).dt.days
     
-    plt.figure(figsize=(10, 6))
-    sns.boxplot(x='BloodType', y='LengthOfStay', data=df)
-    plt.title('Hospital Stay Duration by Blood Type')
-    plt.xlabel('Blood Type')
-    plt.ylabel('Days in Hospital')
-    blood_type_path = f"{app.config['UPLOAD_FOLDER']}/{file_prefix}_blood_type.png"
-    plt.savefig(blood_type_path)
-    plt.close()
-    plots['blood_type'] = blood_type_path
+    with stage('analyze.encode', len(df)):
+        blood_types, blood_type_labels = encode_labels(df['BloodType'], BLOOD_TYPES)
+        diagnoses, diagnosis_labels = encode_labels(df['Diagnosis'])
+        stay = df['LengthOfStay'].to_numpy(dtype=float)
+        valid = ~np.isnan(stay)
+        stay = stay[valid].astype(np.int64)
+        blood_types = blood_types[valid].astype(np.int64)
+        n_blood, n_diag = len(blood_type_labels) + 1, len(diagnosis_labels) + 1
     
-    plt.figure(figsize=(12, 6))
-    top_diagnoses = df['Diagnosis'].value_counts().head(5).index
-    df_top = df[df['Diagnosis'].isin(top_diagnoses)]
-    sns.boxplot(x='Diagnosis', y='LengthOfStay', hue='BloodType', data=df_top)
-    plt.title('Hospital Stay by Diagnosis and Blood Type')
-    plt.xticks(rotation=45)
-    plt.tight_layout()
-    blood_diag_path = f"{app.config['UPLOAD_FOLDER']}/{file_prefix}_blood_diag.png"
-    plt.savefig(blood_diag_path)
-    plt.close()
-    plots['blood_diagnosis'] = blood_diag_path
+    with stage('analyze.bincount', len(stay)):
+        cells = blood_types * n_diag + diagnoses[valid]
+        counts = np.bincount(cells, minlength=n_blood * n_diag).reshape(n_blood, n_diag)
+        totals = np.bincount(cells, weights=stay, minlength=n_blood * n_diag).reshape(n_blood, n_diag)
+        offset = stay.min()
+        span = stay.max() - offset + 1
+        stay_hist = np.bincount(blood_types * span + (stay - offset), minlength=n_blood * span).reshape(n_blood, span)
+        values = np.arange(span) + offset
     
-    plt.figure(figsize=(10, 6))
-    sns.histplot(df['LengthOfStay'], bins=20, kde=True)
-    plt.title('Distribution of Hospital Stay Duration')
-    plt.xlabel('Days')
-    plt.ylabel('Number of Patients')
-    hist_path = f"{app.config['UPLOAD_FOLDER']}/{file_prefix}_hist.png"
-    plt.savefig(hist_path)
-    plt.close()
-    plots['histogram'] = hist_path
+    with stage('analyze.group_stats'):
+        blood_counts, blood_totals = counts[:-1].sum(axis=1), totals[:-1].sum(axis=1)
+        seen = np.flatnonzero(blood_counts)
+        blood_type_stats = pd.DataFrame({
+            'mean': blood_totals[seen] / blood_counts[seen],
+            'count': blood_counts[seen],
+            'median': [float(weighted_quantile(values, stay_hist[i], 0.5)) for i in seen]
+        }, index=[blood_type_labels[i] for i in seen])
+        
+        diag_counts, diag_totals = counts[:, :-1].sum(axis=0), totals[:, :-1].sum(axis=0)
+        seen = np.flatnonzero(diag_counts)
+        diagnosis_stats = pd.DataFrame({
+            'mean': diag_totals[seen] / diag_counts[seen],
+            'count': diag_counts[seen]
+        }, index=[diagnosis_labels[i] for i in seen])
+        
+        with np.errstate(invalid='ignore', divide='ignore'):
+            blood_diagnosis = pd.DataFrame(totals[:-1, :-1] / counts[:-1, :-1], index=blood_type_labels, columns=diagnosis_labels)
+        blood_diagnosis = blood_diagnosis.loc[counts[:-1, :-1].any(axis=1), counts[:-1, :-1].any(axis=0)]
     
-    blood_type_counts = df['BloodType'].value_counts()
-    plt.figure(figsize=(8, 8))
-    plt.pie(blood_type_counts, labels=blood_type_counts.index, autopct='%1.1f%%')
-    plt.title('Blood Type Distribution')
-    pie_path = f"{app.config['UPLOAD_FOLDER']}/{file_prefix}_pie.png"
-    plt.savefig(pie_path)
-    plt.close()
-    plots['pie'] = pie_path
+    with stage('analyze.monthly', len(df)):
+        months = df['AdmissionDate'].to_numpy().astype('datetime64[M]')
+        months = months[~np.isnat(months)].astype(np.int64)
+        month_counts = np.bincount(months - months.min()) if len(months) else np.array([], dtype=np.int64)
+        monthly_trend = pd.Series({str(np.datetime64(int(months.min() + i), 'M')): int(month_counts[i])
+                                   for i in np.flatnonzero(month_counts)}, dtype='int64')
     
+    with stage('analyze.format'):
+        return format_results(len(df), values, stay_hist.sum(axis=0), blood_type_stats, diagnosis_stats, blood_diagnosis, monthly_trend)
+
+def weighted_quantile(values, counts, q):
+    cum = np.cumsum(counts)
+    pos = np.asarray(q, dtype=float) * (cum[-1] - 1)
+    lower = values[np.searchsorted(cum, np.floor(pos), side='right')]
+    upper = values[np.searchsorted(cum, np.ceil(pos), side='right')]
+    return lower + (upper - lower) * (pos - np.floor(pos))
+
+def _merge_counts(left, right):
+    if left.empty:
+        return right.copy()
+    if right.empty:
+        return left
+    return left.add(right, fill_value=0).astype('int64')
+
+class StayAggregates:
+    # Mergeable partial aggregates. Stays are whole days, so keeping a count per
+    # (BloodType, Diagnosis, LengthOfStay) cell gives exact medians in bounded memory.
+    def __init__(self):
+        self.rows = 0
+        self.stays = pd.Series(dtype='int64')
+        self.cells = pd.Series(dtype='int64')
+        self.months = pd.Series(dtype='int64')
+
+    def update(self, df):
+        stay = (df['DischargeDate'] - df['AdmissionDate']).dt.days
+        frame = pd.DataFrame({'BloodType': df['BloodType'], 'Diagnosis': df['Diagnosis'], 'LengthOfStay': stay})
+        frame = frame.dropna(subset=['LengthOfStay']).astype({'LengthOfStay': 'int64'})
+        self.rows += len(df)
+        self.stays = _merge_counts(self.stays, frame['LengthOfStay'].value_counts())
+        # Keep cells with a missing label; each grouping drops NaN only from the levels it groups by.
+        self.cells = _merge_counts(self.cells, frame.groupby(['BloodType', 'Diagnosis', 'LengthOfStay'], observed=True, dropna=False).size())
+        months = df['AdmissionDate'].dt.to_period('M').value_counts()
+        months.index = months.index.astype(str)
+        self.months = _merge_counts(self.months, months)
+        return self
+
+    def merge(self, other):
+        self.rows += other.rows
+        self.stays = _merge_counts(self.stays, other.stays)
+        self.cells = _merge_counts(self.cells, other.cells)
+        self.months = _merge_counts(self.months, other.months)
+        return self
+
+    def _group_stats(self, level, with_median=False):
+        cells = self.cells.rename('n').reset_index()
+        cells['total'] = cells['LengthOfStay'] * cells['n']
+        stats = cells.groupby(level, observed=True).agg(count=('n', 'sum'), total=('total', 'sum'))
+        stats['mean'] = stats['total'] / stats['count']
+        if with_median:
+            hist = cells.groupby([level, 'LengthOfStay'], observed=True)['n'].sum()
+            stats['median'] = hist.groupby(level=0).apply(
+                lambda h: float(weighted_quantile(h.index.get_level_values(1).to_numpy(), h.to_numpy(), 0.5)))
+        return stats
+
+    def stay_histograms(self, by, diagnoses=None):
+        levels = [by] if isinstance(by, str) else list(by)
+        cells = self.cells
+        if diagnoses is not None:
+            cells = cells[cells.index.get_level_values('Diagnosis').isin(diagnoses)]
+        hist = cells.groupby(level=levels + ['LengthOfStay'], observed=True).sum()
+        for key, group in hist.groupby(level=by, observed=True):
+            yield key, group.index.get_level_values('LengthOfStay').to_numpy(), group.to_numpy()
+
+    def results(self):
+        blood_diagnosis = self._group_stats(['BloodType', 'Diagnosis'])['mean'].unstack()
+        return format_results(self.rows, self.stays.index.to_numpy(), self.stays.to_numpy(),
+                              self._group_stats('BloodType', with_median=True)[['mean', 'count', 'median']],
+                              self._group_stats('Diagnosis')[['mean', 'count']],
+                              blood_diagnosis, self.months)
+
+def dense_stay_counts(aggregates):
+    # (BloodType, Diagnosis, LengthOfStay) counts as a dense tensor; stays are whole days, so this is small.
+    # As with encode_labels, a missing label maps to the extra slot at the end of its axis.
+    index = aggregates.cells.index
+    bt, blood_types = encode_labels(pd.Series(index.get_level_values('BloodType')))
+    dx, diagnoses = encode_labels(pd.Series(index.get_level_values('Diagnosis')))
+    values, stay = np.unique(index.get_level_values('LengthOfStay').to_numpy(), return_inverse=True)
+    counts = np.zeros((len(blood_types) + 1, len(diagnoses) + 1, len(values)), dtype=np.int64)
+    np.add.at(counts, (bt, dx, stay), aggregates.cells.to_numpy())
+    return blood_types, diagnoses, values, counts
+
+def midranks(totals):
+    # Average rank of each tied stay value when all rows of the histogram are ranked together.
+    return np.cumsum(totals, axis=-1) - totals + (totals + 1) / 2
+
+def tie_sum(totals):
+    totals = totals.astype(float)
+    return (totals ** 3 - totals).sum(axis=-1)
+
+def normal_sf(z):
+    return 0.5 * np.vectorize(math.erfc, otypes=[float])(np.asarray(z, dtype=float) / math.sqrt(2))
+
+def chi2_sf(x, df):
+    # Closed form of the chi-square survival function for integer degrees of freedom.
+    x, df = np.broadcast_arrays(np.asarray(x, dtype=float), np.asarray(df))
+    half = np.maximum(x, 0) / 2
+    p = np.full(x.shape, np.nan)
+    for k in np.unique(df[df > 0]):
+        mask = df == k
+        h = half[mask]
+        if k % 2 == 0:
+            terms = [h ** i / math.factorial(i) for i in range(k // 2)]
+            p[mask] = np.exp(-h) * np.sum(terms, axis=0)
+        else:
+            terms = [np.zeros_like(h)] + [(2 * h) ** (i - 0.5) / np.prod(np.arange(1, 2 * i, 2)) for i in range(1, (k + 1) // 2)]
+            p[mask] = 2 * normal_sf(np.sqrt(2 * h)) + math.sqrt(2 / math.pi) * np.exp(-h) * np.sum(terms, axis=0)
+    return np.clip(p, 0, 1)
+
+def kruskal_wallis(counts):
+    # counts: (groups, ..., values) histograms; the test runs over the first axis for every other index.
+    totals = counts.sum(axis=0)
+    N = totals.sum(axis=-1).astype(float)
+    n = counts.sum(axis=-1).astype(float)
+    rank_sums = (counts * midranks(totals)).sum(axis=-1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        h = 12 / (N * (N + 1)) * np.where(n > 0, rank_sums ** 2 / n, 0).sum(axis=0) - 3 * (N + 1)
+        h = h / (1 - tie_sum(totals) / (N ** 3 - N))
+    df = (n > 0).sum(axis=0) - 1
+    valid = (df > 0) & np.isfinite(h)
+    p = np.where(valid, chi2_sf(np.where(valid, h, 0), np.where(valid, df, 0)), np.nan)
+    return np.where(valid, h, np.nan), df, p
+
+def mann_whitney(a, b):
+    # Two-sided Mann-Whitney U from histograms, normal approximation with tie and continuity correction.
+    totals = a + b
+    n1 = a.sum(axis=-1).astype(float)
+    n2 = b.sum(axis=-1).astype(float)
+    N = n1 + n2
+    u = (a * midranks(totals)).sum(axis=-1) - n1 * (n1 + 1) / 2
+    with np.errstate(divide='ignore', invalid='ignore'):
+        sigma = np.sqrt(n1 * n2 / 12 * ((N + 1) - tie_sum(totals) / (N * (N - 1))))
+        z = (np.abs(u - n1 * n2 / 2) - 0.5) / sigma
+    valid = (n1 > 0) & (n2 > 0) & (sigma > 0)
+    p = np.where(valid, np.minimum(1, 2 * normal_sf(np.where(valid, np.maximum(z, 0), 0))), np.nan)
+    return u, p
+
+def adjust_pvalues(p, method=None):
+    method = method or app.config['STATS_CORRECTION']
+    p = np.asarray(p, dtype=float)
+    adjusted = np.full(p.shape, np.nan)
+    valid = np.flatnonzero(~np.isnan(p))
+    m = len(valid)
+    if not m:
+        return adjusted
+    order = valid[np.argsort(p[valid], kind='stable')]
+    ranked = p[order]
+    if method == 'holm':
+        ranked = np.maximum.accumulate(ranked * (m - np.arange(m)))
+    elif method == 'fdr_bh':
+        ranked = np.minimum.accumulate((ranked * m / np.arange(1, m + 1))[::-1])[::-1]
+    elif method == 'bonferroni':
+        ranked = ranked * m
+    else:
+        raise AnalysisError(f'Unknown correction method: {method}')
+    adjusted[order] = np.minimum(ranked, 1)
+    return adjusted
+
+def bootstrap_block(values, hists, resamples, seed):
+    # Resampling n rows with replacement from a histogram is one multinomial draw over its bins.
+    rng = np.random.default_rng(seed)
+    n = hists.sum(axis=1)
+    counts = rng.multinomial(n, hists / n[:, None], size=(resamples, len(n)))
+    means = (counts * values).sum(axis=2) / n
+    cum = np.cumsum(counts, axis=2)
+    pos = (n - 1) / 2
+    lower = np.take_along_axis(values, (cum <= np.floor(pos)[:, None]).sum(axis=2).T, axis=1).T
+    upper = np.take_along_axis(values, (cum <= np.ceil(pos)[:, None]).sum(axis=2).T, axis=1).T
+    medians = lower + (upper - lower) * (pos - np.floor(pos))
+    return means, medians
+
+def bootstrap_intervals(values, hists, resamples=None, confidence=None, seed=None, threads=None):
+    # Percentile intervals for the mean and median of each histogram row. Rows are split into blocks
+    # with their own seed, so the result depends on the seed but not on the thread count.
+    resamples = resamples or app.config['STATS_RESAMPLES']
+    confidence = confidence or app.config['STATS_CONFIDENCE']
+    seed = app.config['STATS_SEED'] if seed is None else seed
+    support = (hists > 0).sum(axis=1)
+    order = np.argsort(-support, kind='stable')
+    blocks = []
+    start = 0
+    while start < len(order):
+        # Rows with similar support share a block trimmed to their nonzero bins, which keeps the draws small.
+        size = max(1, app.config['STATS_BLOCK_ELEMENTS'] // (resamples * max(int(support[order[start]]), 1)))
+        blocks.append(order[start:start + size])
+        start += size
+    seeds = np.random.SeedSequence(seed).spawn(len(blocks))
+
+    def run(block, block_seed):
+        rows = hists[block]
+        width = int((rows > 0).sum(axis=1).max())
+        keep = np.argsort(rows == 0, axis=1, kind='stable')[:, :width]
+        return bootstrap_block(values[keep], np.take_along_axis(rows, keep, axis=1), resamples, block_seed)
+
+    quantiles = [(1 - confidence) / 2, 1 - (1 - confidence) / 2]
+    mean_ci = np.full((len(hists), 2), np.nan)
+    median_ci = np.full((len(hists), 2), np.nan)
+    with ThreadPoolExecutor(max_workers=threads or app.config['STATS_THREADS']) as pool:
+        for block, (means, medians) in zip(blocks, pool.map(run, blocks, seeds)):
+            mean_ci[block] = np.quantile(means, quantiles, axis=0).T
+            median_ci[block] = np.quantile(medians, quantiles, axis=0).T
+    return mean_ci, median_ci
+
+def significance_tests(aggregates, resamples=None, seed=None, threads=None):
+    blood_types, diagnoses, values, counts = dense_stay_counts(aggregates)
+    # Blood type tests count rows without a diagnosis, like analyze_data; per-diagnosis tests need both labels.
+    by_blood_type = counts[:-1].sum(axis=1)
+    counts = counts[:-1, :-1]
+    confidence = app.config['STATS_CONFIDENCE']
+    min_count = app.config['STATS_MIN_COUNT']
+
+    with stage('stats.rank_tests', aggregates.rows):
+        h, df, p = kruskal_wallis(by_blood_type[:, None, :])
+        pairs = [(i, j) for i in range(len(blood_types)) for j in range(i + 1, len(blood_types))]
+        pair_u, pair_p = mann_whitney(by_blood_type[[i for i, _ in pairs]], by_blood_type[[j for _, j in pairs]])
+        pair_adjusted = adjust_pvalues(pair_p)
+        diagnosis_h, diagnosis_df, diagnosis_p = kruskal_wallis(counts)
+        diagnosis_adjusted = adjust_pvalues(diagnosis_p)
+        # Each cell is tested against the other blood types with the same diagnosis.
+        cell_u, cell_p = mann_whitney(counts, counts.sum(axis=0) - counts)
+        cell_n = counts.sum(axis=2)
+        cell_p = np.where(cell_n >= min_count, cell_p, np.nan)
+        cell_adjusted = adjust_pvalues(cell_p.ravel()).reshape(cell_p.shape)
+
+    with stage('stats.bootstrap', aggregates.rows):
+        bt_rows = np.flatnonzero(by_blood_type.sum(axis=1) >= min_count)
+        bt_mean_ci, bt_median_ci = bootstrap_intervals(values, by_blood_type[bt_rows], resamples, confidence, seed, threads)
+        cells = np.argwhere(cell_n >= min_count)
+        cell_mean_ci, cell_median_ci = bootstrap_intervals(values, counts[cells[:, 0], cells[:, 1]], resamples, confidence, seed, threads)
+
+    def number(x, digits=4):
+        return None if np.isnan(x) else float(round(float(x), digits))
+
+    def interval(ci):
+        return [number(ci[0], 2), number(ci[1], 2)]
+
+    def summary(hist):
+        n = hist.sum()
+        return {
+            'count': int(n),
+            'mean': number((hist * values).sum() / n, 2) if n else None,
+            'median': number(weighted_quantile(values, hist, 0.5), 2) if n else None
+        }
+
+    alpha = 1 - confidence
+    blood_type_intervals = {}
+    for k, row in enumerate(bt_rows):
+        blood_type_intervals[blood_types[row]] = dict(summary(by_blood_type[row]),
+                                                      mean_ci=interval(bt_mean_ci[k]), median_ci=interval(bt_median_ci[k]))
+    blood_diagnosis = {}
+    for d, diagnosis in enumerate(diagnoses):
+        blood_diagnosis[diagnosis] = {
+            'kruskal_wallis': {'h': number(diagnosis_h[d]),
+                               'df': int(diagnosis_df[d]), 'p_value': number(diagnosis_p[d], 6),
+                               'p_adjusted': number(diagnosis_adjusted[d], 6)},
+            'cells': {}
+        }
+    for k, (b, d) in enumerate(cells):
+        blood_diagnosis[diagnoses[d]]['cells'][blood_types[b]] = dict(
+            summary(counts[b, d]), mean_ci=interval(cell_mean_ci[k]), median_ci=interval(cell_median_ci[k]),
+            u=number(cell_u[b, d], 1), p_value=number(cell_p[b, d], 6), p_adjusted=number(cell_adjusted[b, d], 6),
+            significant=bool(cell_adjusted[b, d] < alpha))
+    return {
+        'method': {
+            'resamples': resamples or app.config['STATS_RESAMPLES'],
+            'seed': app.config['STATS_SEED'] if seed is None else seed,
+            'confidence': confidence,
+            'correction': app.config['STATS_CORRECTION'],
+            'min_count': min_count
+        },
+        'blood_type': {
+            'kruskal_wallis': {'h': number(h[0]), 'df': int(df[0]), 'p_value': number(p[0], 6)},
+            'pairwise': [{
+                'a': blood_types[i], 'b': blood_types[j], 'u': number(pair_u[k], 1),
+                'p_value': number(pair_p[k], 6), 'p_adjusted': number(pair_adjusted[k], 6),
+                'significant': bool(pair_adjusted[k] < alpha)
+            } for k, (i, j) in enumerate(pairs)],
+            'intervals': blood_type_intervals
+        },
+        'blood_diagnosis': blood_diagnosis
+    }
+
+class TrendCube:
+    # Admissions and stay days per (day, BloodType, Diagnosis), kept as prefix sums over the days that
+    # have admissions, so any range and granularity is answered by differencing the cumulative cube at
+    # bucket edges. Days without admissions take no rows, so one mistyped year costs a single day.
+    # The full cubes take days x blood types x diagnoses x 3 metrics x 4-8 bytes, e.g. ~200 MB for ten
+    # years of 500 diagnoses, so cached cubes are budgeted by nbytes (TREND_CACHE_BYTES per process).
+    GRANULARITIES = ('day', 'week', 'month', 'quarter')
+
+    def __init__(self, df):
+        days = df['AdmissionDate'].to_numpy().astype('datetime64[D]')
+        stay = (df['DischargeDate'].to_numpy() - df['AdmissionDate'].to_numpy()).astype('timedelta64[D]')
+        blood_type = encode_labels(df['BloodType'], BLOOD_TYPES)
+        diagnosis = encode_labels(df['Diagnosis'])
+        valid = ~np.isnat(days) & (blood_type[0] < len(blood_type[1])) & (diagnosis[0] < len(diagnosis[1]))
+        days, stay = days[valid].astype(np.int64), stay[valid]
+        self.blood_types = list(blood_type[1])
+        self.diagnoses = list(diagnosis[1])
+        # Integer day offsets since 1970-01-01 of the days with admissions, in order.
+        self.day_values, day_index = np.unique(days, return_inverse=True)
+        self.days = len(self.day_values)
+        shape = (self.days, len(self.blood_types), len(self.diagnoses))
+        cell = np.ravel_multi_index((day_index.ravel(), blood_type[0][valid], diagnosis[0][valid]), shape)
+        size = int(np.prod(shape))
+        known = ~np.isnat(stay)
+        metrics = {
+            'admissions': np.bincount(cell, minlength=size),
+            'stays': np.bincount(cell, weights=known, minlength=size),
+            'stay_days': np.bincount(cell, weights=np.where(known, stay.astype(np.int64), 0), minlength=size)
+        }
+        self.cubes = {}
+        for name, values in metrics.items():
+            values = values.astype(np.int64).reshape(shape)
+            dtype = np.int32 if values.sum() < np.iinfo(np.int32).max else np.int64
+            for dims, cube in (('full', values), ('blood_type', values.sum(axis=2)), ('diagnosis', values.sum(axis=1))):
+                cumulative = np.zeros((self.days + 1,) + cube.shape[1:], dtype=dtype)
+                np.cumsum(cube, axis=0, out=cumulative[1:])
+                self.cubes[name, dims] = cumulative
+        self.rollups = {granularity: self.bucket_ids(granularity, self.day_values) for granularity in self.GRANULARITIES}
+        self.nbytes = (sum(cube.nbytes for cube in self.cubes.values()) + self.day_values.nbytes
+                       + sum(rollup.nbytes for rollup in self.rollups.values()))
+
+    @staticmethod
+    def bucket_ids(granularity, day):
+        # Consecutive buckets have consecutive ids, so the buckets of a range are an arange.
+        if granularity == 'week':
+            return (day + 3) // 7
+        if granularity in ('month', 'quarter'):
+            month = day.astype('datetime64[D]').astype('datetime64[M]').astype(np.int64)
+            return month if granularity == 'month' else month // 3
+        return day
+
+    @staticmethod
+    def bucket_labels(granularity, buckets):
+        if granularity == 'week':
+            return np.datetime_as_string((buckets * 7 - 3).astype('datetime64[D]')).tolist()
+        if granularity == 'month':
+            return np.datetime_as_string(buckets.astype('datetime64[M]')).tolist()
+        if granularity == 'quarter':
+            return [f'{1970 + q // 4}-Q{q % 4 + 1}' for q in buckets.tolist()]
+        return np.datetime_as_string(buckets.astype('datetime64[D]')).tolist()
+
+    def query(self, granularity='month', start=None, end=None, blood_types=None, diagnoses=None, by=None):
+        if granularity not in self.GRANULARITIES:
+            raise AnalysisError(f'granularity must be one of: {", ".join(self.GRANULARITIES)}')
+        if by not in (None, 'blood_type', 'diagnosis'):
+            raise AnalysisError('by must be blood_type or diagnosis')
+        for name, labels, known in (('blood_type', blood_types, self.blood_types), ('diagnosis', diagnoses, self.diagnoses)):
+            unknown = set(labels or []) - set(known)
+            if unknown:
+                raise AnalysisError(f'Unknown {name}: {", ".join(sorted(unknown))}')
+        # The range is clipped to the admitted days; lo:hi are the days with admissions inside it.
+        first_day = int(self.day_values[0]) if self.days else 0
+        last_day = int(self.day_values[-1]) if self.days else -1
+        first_day = first_day if start is None else max(first_day, int(start.astype(np.int64)))
+        last_day = last_day if end is None else min(last_day, int(end.astype(np.int64)))
+        lo = int(np.searchsorted(self.day_values, first_day))
+        hi = max(lo, int(np.searchsorted(self.day_values, last_day, side='right')))
+        buckets = self.rollups[granularity][lo:hi]
+        edges = np.concatenate([[lo], lo + np.flatnonzero(np.diff(buckets)) + 1, [hi]]) if hi > lo else np.array([lo])
+        # Buckets in the range without admissions are reported with zero admissions.
+        if first_day <= last_day:
+            first_bucket, last_bucket = (int(self.bucket_ids(granularity, np.int64(day))) for day in (first_day, last_day))
+        else:
+            first_bucket, last_bucket = 0, -1
+        positions = self.rollups[granularity][edges[:-1]] - first_bucket
+
+        bt = [self.blood_types.index(label) for label in blood_types] if blood_types else np.arange(len(self.blood_types))
+        dx = [self.diagnoses.index(label) for label in diagnoses] if diagnoses else np.arange(len(self.diagnoses))
+        if diagnoses or by == 'diagnosis':
+            dims = 'full' if blood_types or by == 'blood_type' else 'diagnosis'
+        else:
+            dims = 'blood_type'
+        series = {}
+        for name in ('admissions', 'stays', 'stay_days'):
+            cumulative = self.cubes[name, dims]
+            if dims == 'full':
+                at_edges = cumulative[np.ix_(edges, bt, dx)]
+                at_edges = at_edges.sum(axis=2) if by == 'blood_type' else at_edges.sum(axis=1) if by == 'diagnosis' else at_edges.sum(axis=(1, 2))
+            else:
+                at_edges = cumulative[np.ix_(edges, bt if dims == 'blood_type' else dx)]
+                at_edges = at_edges if by else at_edges.sum(axis=1)
+            values = np.diff(at_edges, axis=0)
+            series[name] = np.zeros((last_bucket - first_bucket + 1,) + values.shape[1:], dtype=values.dtype)
+            series[name][positions] = values
+
+        if by is None:
+            keys, columns = ['all'], [0]
+            series = {name: values[:, None] for name, values in series.items()}
+        else:
+            labels = self.blood_types if by == 'blood_type' else self.diagnoses
+            selected = (blood_types if by == 'blood_type' else diagnoses) or labels
+            keys, columns = list(selected), range(len(selected))
+        trend = {}
+        for key, column in zip(keys, columns):
+            admissions = series['admissions'][:, column]
+            with np.errstate(divide='ignore', invalid='ignore'):
+                avg_stay = np.round(series['stay_days'][:, column] / series['stays'][:, column], 2)
+            trend[key] = {
+                'admissions': admissions.astype(int).tolist(),
+                'avg_stay': np.where(np.isnan(avg_stay), None, avg_stay).tolist()
+            }
+        return {
+            'granularity': granularity,
+            'start': str(np.datetime64(first_day, 'D')) if first_day <= last_day else None,
+            'end': str(np.datetime64(last_day, 'D')) if first_day <= last_day else None,
+            'buckets': self.bucket_labels(granularity, np.arange(first_bucket, last_bucket + 1)),
+            'series': trend
+        }
+
+class DatasetIndex:
+    # Row indexes over a retained dataset: packed bitmaps per blood type, row positions grouped by
+    # diagnosis and admission days in sorted order. Filters become bitmaps that are ANDed together.
+    # Each index holds the dataset itself, so cached indexes are budgeted by nbytes (QUERY_INDEX_CACHE_BYTES).
+    RH_GROUPS = {rh: [label for label in BLOOD_TYPES if label.endswith(sign)] for rh, sign in (('negative', '-'), ('positive', '+'))}
+
+    def __init__(self, df):
+        self.df = df
+        self.rows = len(df)
+        blood_types, self.blood_types = encode_labels(df['BloodType'], BLOOD_TYPES)
+        self.blood_type_bitmaps = [np.packbits(blood_types == code) for code in range(len(self.blood_types))]
+        diagnoses, self.diagnoses = encode_labels(df['Diagnosis'])
+        self.diagnosis_rows = np.argsort(diagnoses, kind='stable').astype(np.int32)
+        self.diagnosis_offsets = np.concatenate([[0], np.cumsum(np.bincount(diagnoses, minlength=len(self.diagnoses) + 1))])
+        days = df['AdmissionDate'].to_numpy().astype('datetime64[D]')
+        dated = np.flatnonzero(~np.isnat(days))
+        order = np.argsort(days[dated].astype(np.int64), kind='stable')
+        self.date_rows = dated[order].astype(np.int32)
+        self.admission_days = days[dated][order].astype(np.int64)
+        self.known_stay = ~np.isnat(df['DischargeDate'].to_numpy()) & ~np.isnat(df['AdmissionDate'].to_numpy())
+        arrays = self.blood_type_bitmaps + [self.diagnosis_rows, self.diagnosis_offsets, self.date_rows, self.admission_days, self.known_stay]
+        self.nbytes = int(df.memory_usage(index=True, deep=True).sum()) + sum(array.nbytes for array in arrays)
+
+    def bitmap(self, positions):
+        mask = np.zeros(self.rows, dtype=bool)
+        mask[positions] = True
+        return np.packbits(mask)
+
+    def select(self, blood_types=None, diagnoses=None, start=None, end=None, rh=None):
+        for name, labels, known in (('blood_type', blood_types, self.blood_types), ('diagnosis', diagnoses, self.diagnoses)):
+            unknown = set(labels or []) - set(known)
+            if unknown:
+                raise AnalysisError(f'Unknown {name}: {", ".join(sorted(unknown))}')
+        if rh is not None and rh not in self.RH_GROUPS:
+            raise AnalysisError('rh must be negative or positive')
+
+        bitmaps = []
+        if blood_types:
+            bitmaps.append(np.bitwise_or.reduce([self.blood_type_bitmaps[self.blood_types.index(label)] for label in blood_types]))
+        if rh:
+            bitmaps.append(np.bitwise_or.reduce([self.blood_type_bitmaps[self.blood_types.index(label)] for label in self.RH_GROUPS[rh]]))
+        if diagnoses:
+            codes = [self.diagnoses.index(label) for label in diagnoses]
+            bitmaps.append(self.bitmap(np.concatenate([
+                self.diagnosis_rows[self.diagnosis_offsets[code]:self.diagnosis_offsets[code + 1]] for code in codes])))
+        if start is not None or end is not None:
+            lo = 0 if start is None else np.searchsorted(self.admission_days, start.astype(np.int64), side='left')
+            hi = len(self.admission_days) if end is None else np.searchsorted(self.admission_days, end.astype(np.int64), side='right')
+            bitmaps.append(self.bitmap(self.date_rows[lo:hi]))
+        if not bitmaps:
+            return np.arange(self.rows)
+        return np.flatnonzero(np.unpackbits(np.bitwise_and.reduce(bitmaps), count=self.rows))
+
+    def query(self, **filters):
+        with stage('query.select', self.rows):
+            rows = self.select(**filters)
+        # The analysis is built from lengths of stay, so without any there is nothing to report.
+        if not self.known_stay[rows].any():
+            return rows, None
+        with stage('query.analyze', len(rows)):
+            return rows, analyze_data(self.df.take(rows))
+
+def parse_dates(values):
+    # Date columns are read as categoricals, so each distinct date string is parsed only once.
+    if isinstance(values.dtype, pd.CategoricalDtype):
+        parsed = parse_dates(values.cat.categories.to_series()).to_numpy()
+        return pd.Series(np.append(parsed, np.datetime64('NaT'))[values.cat.codes.to_numpy()], index=values.index)
+    try:
+        return pd.to_datetime(values, format=app.config['DATE_FORMAT'], cache=True)
+    except (ValueError, TypeError):
+        return pd.to_datetime(values, cache=True)
+
+def file_size(file):
+    position = file.tell()
+    file.seek(0, os.SEEK_END)
+    size = file.tell()
+    file.seek(position)
+    return size
+
+def ingest_stats(rows, size, seconds, engine):
+    app.logger.info('Parsed %d rows (%d bytes) in %.3fs with the %s engine', rows, size, seconds, engine)
+    return {
+        'engine': engine,
+        'rows': int(rows),
+        'bytes': int(size),
+        'seconds': round(seconds, 4),
+        'rows_per_sec': int(rows / seconds) if seconds else None,
+        'mb_per_sec': round(size / 1e6 / seconds, 2) if seconds else None
+    }
+
+def check_csv_columns(file):
+    header = pd.read_csv(file, nrows=0)
+    file.seek(0)
+    if not all(col in header.columns for col in REQUIRED_COLUMNS):
+        raise AnalysisError(f'Missing required columns: {", ".join(REQUIRED_COLUMNS)}')
+
+def csv_engine(engine=None):
+    engine = engine or app.config['CSV_ENGINE']
+    if engine == 'pyarrow' and importlib.util.find_spec('pyarrow') is None:
+        return 'c'
+    return engine
+
+def read_patient_csv(file, engine=None):
+    check_csv_columns(file)
+    engine = csv_engine(engine)
+    started = time.perf_counter()
+    with stage('parse.csv') as span:
+        df = pd.read_csv(file, usecols=REQUIRED_COLUMNS, dtype=CSV_DTYPES, engine=engine)
+        span['rows'] = len(df)
+    with stage('parse.dates', len(df)):
+        for col in DATE_COLUMNS:
+            df[col] = parse_dates(df[col])
+    df.attrs['ingest'] = ingest_stats(len(df), file_size(file), time.perf_counter() - started, engine)
+    return df
+
+def excel_engine(filename, engine=None):
+    engine = engine or app.config['EXCEL_ENGINE']
+    if engine == 'calamine' and importlib.util.find_spec('python_calamine') is None:
+        engine = 'openpyxl'
+    if engine == 'openpyxl' and (openpyxl is None or not filename.endswith('.xlsx')):
+        return None
+    return engine
+
+def excel_sheet(sheet=None):
+    sheet = app.config['EXCEL_SHEET'] if sheet in (None, '') else sheet
+    return int(sheet) if isinstance(sheet, str) and sheet.isdigit() else sheet
+
+def excel_dataset_id(digest, filename, sheet=None):
+    # Each sheet of a workbook is converted and stored as its own dataset.
+    sheet = excel_sheet(sheet)
+    if filename.endswith('.csv') or sheet == excel_sheet():
+        return digest
+    return hashlib.sha256(f'{digest}:sheet:{sheet}'.encode()).hexdigest()
+
+def read_excel_columns(file, sheet):
+    # read_only mode streams rows out of the sheet XML instead of building the whole workbook.
+    workbook = openpyxl.load_workbook(file, read_only=True, data_only=True)
+    try:
+        worksheet = workbook.worksheets[sheet] if isinstance(sheet, int) else workbook[sheet]
+        header = next(worksheet.iter_rows(max_row=1, values_only=True), ())
+        if not all(col in header for col in REQUIRED_COLUMNS):
+            raise AnalysisError(f'Missing required columns: {", ".join(REQUIRED_COLUMNS)}')
+        positions = [header.index(col) for col in REQUIRED_COLUMNS]
+        first = min(positions)
+        columns = [[] for _ in REQUIRED_COLUMNS]
+        rows = worksheet.iter_rows(min_row=2, min_col=first + 1, max_col=max(positions) + 1, values_only=True)
+        for row in rows:
+            if any(value is not None for value in row):
+                for values, position in zip(columns, positions):
+                    values.append(row[position - first])
+    except (IndexError, KeyError):
+        raise AnalysisError(f'Worksheet not found: {sheet}')
+    finally:
+        workbook.close()
+    return pd.DataFrame(dict(zip(REQUIRED_COLUMNS, columns)), columns=REQUIRED_COLUMNS)
+
+def read_patient_excel(file, filename, sheet=None, engine=None):
+    engine = excel_engine(filename, engine)
+    sheet = excel_sheet(sheet)
+    started = time.perf_counter()
+    with stage('parse.excel') as span:
+        if engine == 'openpyxl':
+            df = read_excel_columns(file, sheet)
+        else:
+            try:
+                df = pd.read_excel(file, sheet_name=sheet, engine=engine, usecols=lambda col: col in REQUIRED_COLUMNS)
+            except (IndexError, KeyError, ValueError) as e:
+                raise AnalysisError(f'Worksheet not found: {sheet}') from e
+            if not all(col in df.columns for col in REQUIRED_COLUMNS):
+                raise AnalysisError(f'Missing required columns: {", ".join(REQUIRED_COLUMNS)}')
+        span['rows'] = len(df)
+    df = df[REQUIRED_COLUMNS].astype({col: CSV_DTYPES[col] for col in CATEGORICAL_COLUMNS + DATE_COLUMNS})
+    df['PatientID'] = df['PatientID'].map(patient_id_text).astype(object)
+    with stage('parse.dates', len(df)):
+        for col in DATE_COLUMNS:
+            df[col] = parse_dates(df[col])
+    df.attrs['ingest'] = ingest_stats(len(df), file_size(file), time.perf_counter() - started, engine or 'excel')
+    return df
+
+def analyze_csv_stream(file, chunksize=None, report=None, writer=None):
+    aggregates = StayAggregates()
+    chunks = pd.read_csv(file, usecols=REQUIRED_COLUMNS, dtype=CSV_DTYPES, chunksize=chunksize or app.config['CSV_CHUNK_SIZE'])
+    for chunk in chunks:
+        for col in DATE_COLUMNS:
+            chunk[col] = parse_dates(chunk[col])
+        aggregates.update(chunk)
+        if writer:
+            writer.write(chunk)
+        if report:
+            report('parsing', aggregates.rows)
+    return aggregates
+
+class ChartBuffer(io.BytesIO):
+    # Render target for charts that are kept in memory instead of written to UPLOAD_FOLDER.
+    def __init__(self, format='png'):
+        super().__init__()
+        self.format = format
+
+def chart_target(file_prefix, name):
+    if app.config['CHART_STORAGE'] == 'disk':
+        return f"{app.config['UPLOAD_FOLDER']}/{file_prefix}_{name}.png"
+    return ChartBuffer()
+
+def save_figure(fig, target, dpi=None):
+    fig.savefig(target, dpi=dpi, format=target.format if isinstance(target, ChartBuffer) else None)
+    return target
+
+def chart_reference(target):
+    if isinstance(target, ChartBuffer):
+        return f'data:{CHART_FORMATS[target.format]};base64,' + base64.b64encode(target.getvalue()).decode()
+    return target
+
+def render_blood_type_chart(data, path, size=None, dpi=None):
+    import seaborn as sns
+    fig = Figure(figsize=size or (10, 6))
+    ax = fig.subplots()
+    sns.boxplot(x='BloodType', y='LengthOfStay', data=data, ax=ax)
+    ax.set_title('Hospital Stay Duration by Blood Type')
+    ax.set_xlabel('Blood Type')
+    ax.set_ylabel('Days in Hospital')
+    return save_figure(fig, path, dpi)
+
+def render_blood_diagnosis_chart(data, path, size=None, dpi=None):
+    import seaborn as sns
+    fig = Figure(figsize=size or (12, 6))
+    ax = fig.subplots()
+    sns.boxplot(x='Diagnosis', y='LengthOfStay', hue='BloodType', data=data, ax=ax)
+    ax.set_title('Hospital Stay by Diagnosis and Blood Type')
+    ax.tick_params(axis='x', labelrotation=45)
+    fig.tight_layout()
+    return save_figure(fig, path, dpi)
+
+def render_histogram_chart(data, path, size=None, dpi=None):
+    import seaborn as sns
+    fig = Figure(figsize=size or (10, 6))
+    ax = fig.subplots()
+    sns.histplot(data, bins=20, kde=True, ax=ax)
+    ax.set_title('Distribution of Hospital Stay Duration')
+    ax.set_xlabel('Days')
+    ax.set_ylabel('Number of Patients')
+    return save_figure(fig, path, dpi)
+
+def render_pie_chart(data, path, size=None, dpi=None):
+    fig = Figure(figsize=size or (8, 8))
+    ax = fig.subplots()
+    ax.pie(data, labels=data.index, autopct='%1.1f%%')
+    ax.set_title('Blood Type Distribution')
+    return save_figure(fig, path, dpi)
+
+def seaborn_chart_tasks(df, file_prefix):
+    top_diagnoses = df['Diagnosis'].value_counts().head(5).index
+    df_top = df.loc[df['Diagnosis'].isin(top_diagnoses), ['Diagnosis', 'BloodType', 'LengthOfStay']]
+    return {
+        'blood_type': (render_blood_type_chart, df[['BloodType', 'LengthOfStay']], chart_target(file_prefix, 'blood_type')),
+        'blood_diagnosis': (render_blood_diagnosis_chart, df_top, chart_target(file_prefix, 'blood_diag')),
+        'histogram': (render_histogram_chart, df['LengthOfStay'], chart_target(file_prefix, 'hist')),
+        'pie': (render_pie_chart, df['BloodType'].value_counts(), chart_target(file_prefix, 'pie'))
+    }
+
+def box_stats(values, counts, label):
+    q1, med, q3 = weighted_quantile(values, counts, [0.25, 0.5, 0.75])
+    iqr = q3 - q1
+    inside = values[(values >= q1 - 1.5 * iqr) & (values <= q3 + 1.5 * iqr)]
+    fliers = values[(values < inside.min()) | (values > inside.max())]
+    return {
+        'label': label,
+        'q1': float(q1),
+        'med': float(med),
+        'q3': float(q3),
+        'whislo': int(inside.min()),
+        'whishi': int(inside.max()),
+        'fliers': fliers.tolist(),
+        'count': int(counts.sum())
+    }
+
+def binned_kde(values, counts, grid):
+    n = counts.sum()
+    mean = (values * counts).sum() / n
+    std = np.sqrt(((values - mean) ** 2 * counts).sum() / max(n - 1, 1))
+    bandwidth = std * n ** -0.2
+    if bandwidth == 0:
+        return np.zeros_like(grid)
+    z = (grid[:, None] - values[None, :]) / bandwidth
+    return (np.exp(-0.5 * z * z) * counts).sum(axis=1) / (n * bandwidth * np.sqrt(2 * np.pi))
+
+def chart_summary(aggregates):
+    values = aggregates.stays.index.to_numpy()
+    counts = aggregates.stays.to_numpy()
+    edges = np.histogram_bin_edges(values, bins=20, range=(values.min(), values.max()))
+    hist, _ = np.histogram(values, bins=edges, weights=counts)
+    grid = np.linspace(values.min(), values.max(), 200)
+    kde = binned_kde(values, counts, grid) * counts.sum() * (edges[1] - edges[0])
+
+    blood_types = aggregates.cells.groupby(level='BloodType', observed=True).sum().sort_values(ascending=False, kind='stable')
+    diagnoses = aggregates.cells.groupby(level='Diagnosis', observed=True).sum().sort_values(ascending=False, kind='stable')
+    top_diagnoses = list(diagnoses.index[:5])
+    blood_diagnosis = [box_stats(v, c, [diagnosis, blood_type])
+                       for (blood_type, diagnosis), v, c in aggregates.stay_histograms(['BloodType', 'Diagnosis'], top_diagnoses)]
+    return {
+        'blood_type': [box_stats(v, c, label) for label, v, c in aggregates.stay_histograms('BloodType')],
+        'blood_diagnosis': {
+            'diagnoses': top_diagnoses,
+            'blood_types': sorted({box['label'][1] for box in blood_diagnosis}),
+            'boxes': blood_diagnosis
+        },
+        'histogram': {
+            'edges': edges.tolist(),
+            'counts': hist.astype(int).tolist(),
+            'kde_x': np.round(grid, 3).tolist(),
+            'kde_y': np.round(kde, 3).tolist()
+        },
+        'pie': {'labels': blood_types.index.tolist(), 'counts': blood_types.astype(int).tolist()}
+    }
+
+def render_summary_blood_type_chart(boxes, path, size=None, dpi=None):
+    fig = Figure(figsize=size or (10, 6))
+    ax = fig.subplots()
+    ax.bxp(boxes, patch_artist=True, boxprops={'facecolor': 'C0'}, medianprops={'color': 'black'})
+    ax.set_title('Hospital Stay Duration by Blood Type')
+    ax.set_xlabel('Blood Type')
+    ax.set_ylabel('Days in Hospital')
+    return save_figure(fig, path, dpi)
+
+def render_summary_blood_diagnosis_chart(summary, path, size=None, dpi=None):
+    fig = Figure(figsize=size or (12, 6))
+    ax = fig.subplots()
+    blood_types = summary['blood_types']
+    width = 0.8 / max(len(blood_types), 1)
+    for j, blood_type in enumerate(blood_types):
+        boxes = [dict(box, label='') for box in summary['boxes'] if box['label'][1] == blood_type]
+        positions = [summary['diagnoses'].index(box['label'][0]) - 0.4 + width * (j + 0.5)
+                     for box in summary['boxes'] if box['label'][1] == blood_type]
+        ax.bxp(boxes, positions=positions, widths=width * 0.9, patch_artist=True, manage_ticks=False,
+               boxprops={'facecolor': f'C{j}'}, medianprops={'color': 'black'}, flierprops={'markersize': 3})
+    ax.set_xticks(range(len(summary['diagnoses'])), summary['diagnoses'], rotation=45)
+    ax.legend(handles=[Patch(facecolor=f'C{j}', label=bt) for j, bt in enumerate(blood_types)], title='BloodType')
+    ax.set_title('Hospital Stay by Diagnosis and Blood Type')
+    ax.set_xlabel('Diagnosis')
+    ax.set_ylabel('LengthOfStay')
+    fig.tight_layout()
+    return save_figure(fig, path, dpi)
+
+def render_summary_histogram_chart(summary, path, size=None, dpi=None):
+    fig = Figure(figsize=size or (10, 6))
+    ax = fig.subplots()
+    ax.stairs(summary['counts'], summary['edges'], fill=True, alpha=0.5, color='C0')
+    ax.stairs(summary['counts'], summary['edges'], color='C0')
+    ax.plot(summary['kde_x'], summary['kde_y'], color='C0')
+    ax.set_title('Distribution of Hospital Stay Duration')
+    ax.set_xlabel('Days')
+    ax.set_ylabel('Number of Patients')
+    return save_figure(fig, path, dpi)
+
+def render_summary_pie_chart(summary, path, size=None, dpi=None):
+    fig = Figure(figsize=size or (8, 8))
+    ax = fig.subplots()
+    ax.pie(summary['counts'], labels=summary['labels'], autopct='%1.1f%%')
+    ax.set_title('Blood Type Distribution')
+    return save_figure(fig, path, dpi)
+
+def summary_chart_tasks(summary, file_prefix):
+    return {
+        'blood_type': (render_summary_blood_type_chart, summary['blood_type'], chart_target(file_prefix, 'blood_type')),
+        'blood_diagnosis': (render_summary_blood_diagnosis_chart, summary['blood_diagnosis'], chart_target(file_prefix, 'blood_diag')),
+        'histogram': (render_summary_histogram_chart, summary['histogram'], chart_target(file_prefix, 'hist')),
+        'pie': (render_summary_pie_chart, summary['pie'], chart_target(file_prefix, 'pie'))
+    }
+
+def chart_tasks(df, file_prefix):
+    if app.config['CHART_RENDERER'] == 'summary':
+        with stage('chart.summary', len(df)):
+            summary = chart_summary(StayAggregates().update(df))
+        return summary_chart_tasks(summary, file_prefix)
+    return seaborn_chart_tasks(df, file_prefix)
+
+_chart_pool = None
+
+def chart_pool():
+    global _chart_pool
+    if _chart_pool is None:
+        _chart_pool = ProcessPoolExecutor(max_workers=app.config['CHART_WORKERS'])
+    return _chart_pool
+
+def observe_chart(name, submitted, future):
+    stage_metrics.observe(f'chart.{name}', time.perf_counter() - submitted)
+
+def submit_charts(tasks):
+    futures = {}
+    for name, (render, data, path) in tasks.items():
+        futures[name] = chart_pool().submit(render, data, path)
+        futures[name].add_done_callback(partial(observe_chart, name, time.perf_counter()))
+    return futures
+
+def run_chart_tasks(tasks):
+    # Job workers are pool processes themselves, so they render in-process rather than nest pools.
+    if app.config['CHART_WORKERS'] > 1 and multiprocessing.parent_process() is None:
+        return {name: chart_reference(future.result()) for name, future in submit_charts(tasks).items()}
+    plots = {}
+    for name, (render, data, path) in tasks.items():
+        with stage(f'chart.{name}'):
+            plots[name] = chart_reference(render(data, path))
     return plots
 
+def generate_visualizations(df, file_prefix):
+    return run_chart_tasks(chart_tasks(df, file_prefix))
+
+def file_digest(file):
+    digest = hashlib.sha256()
+    for block in iter(lambda: file.read(1 << 20), b''):
+        digest.update(block)
+    file.seek(0)
+    return digest.hexdigest()
+
+def result_cache_key(digest, mode, render='server'):
+    return hashlib.sha256(f'{digest}:{ANALYSIS_VERSION}:{mode}:{render}'.encode()).hexdigest()
+
+class ArtifactStore:
+    # Chart files under UPLOAD_FOLDER, tracked in a SQLite index and evicted least recently used first
+    # once they exceed ARTIFACT_MAX_BYTES or ARTIFACT_MAX_AGE. Files referenced by cached results are kept.
+    # Charts held in memory (CHART_STORAGE = 'memory') are budgeted separately by ARTIFACT_MEMORY_BYTES.
+    def __init__(self):
+        self.refs = Counter()
+        self.memory = OrderedDict()
+        self.memory_size = 0
+        self.lock = threading.Lock()
+
+    def owns(self, path):
+        return path.startswith(os.path.join(app.config['UPLOAD_FOLDER'], ''))
+
+    def connect(self):
+        # UPLOAD_FOLDER is served as static files, so the index defaults to DATASET_FOLDER instead.
+        index = app.config['ARTIFACT_INDEX'] or os.path.join(app.config['DATASET_FOLDER'], '.artifacts.sqlite')
+        created = not os.path.exists(index)
+        db = sqlite3.connect(index, timeout=30)
+        db.execute('CREATE TABLE IF NOT EXISTS artifacts (path TEXT PRIMARY KEY, size INTEGER, accessed REAL)')
+        if created:
+            # Earlier versions kept the index in UPLOAD_FOLDER, where anyone could download it.
+            try:
+                os.remove(os.path.join(app.config['UPLOAD_FOLDER'], '.artifacts.sqlite'))
+            except FileNotFoundError:
+                pass
+            self.adopt(db)
+        return db
+
+    def adopt(self, db):
+        # Files written before the index existed are registered by their modification time.
+        for folder, _, names in os.walk(app.config['UPLOAD_FOLDER']):
+            for name in names:
+                if name.startswith('.'):
+                    continue
+                stat = os.stat(os.path.join(folder, name))
+                db.execute('INSERT OR IGNORE INTO artifacts VALUES (?, ?, ?)',
+                           (os.path.join(folder, name), stat.st_size, stat.st_mtime))
+        db.commit()
+
+    def add(self, paths):
+        with closing(self.connect()) as db, db:
+            db.executemany('INSERT OR REPLACE INTO artifacts VALUES (?, ?, ?)',
+                           [(path, os.path.getsize(path), time.time()) for path in paths if os.path.exists(path)])
+        self.evict()
+
+    def touch(self, paths):
+        now = time.time()
+        with closing(self.connect()) as db, db:
+            db.executemany('UPDATE artifacts SET accessed = ? WHERE path = ?', [(now, path) for path in paths])
+
+    def acquire(self, paths):
+        paths = [path for path in paths if self.owns(path)]
+        with self.lock:
+            self.refs.update(paths)
+        self.add(paths)
+
+    def release(self, paths):
+        with self.lock:
+            self.refs.subtract(path for path in paths if self.owns(path))
+            self.refs = +self.refs
+
+    def available(self, reference):
+        # Inline data URIs and lazy chart URLs are always servable.
+        return not self.owns(reference) or os.path.exists(reference)
+
+    def evict(self):
+        max_bytes, max_age = app.config['ARTIFACT_MAX_BYTES'], app.config['ARTIFACT_MAX_AGE']
+        cutoff = time.time() - max_age if max_age else 0
+        with self.lock, closing(self.connect()) as db, db:
+            total, oldest = db.execute('SELECT COALESCE(SUM(size), 0), MIN(accessed) FROM artifacts').fetchone()
+            if total <= max_bytes and (oldest is None or oldest >= cutoff):
+                return
+            removed = []
+            for path, size, accessed in db.execute('SELECT path, size, accessed FROM artifacts ORDER BY accessed'):
+                if total <= max_bytes and accessed >= cutoff:
+                    break
+                if self.refs[path]:
+                    continue
+                if os.path.exists(path):
+                    os.remove(path)
+                removed.append((path,))
+                total -= size
+            db.executemany('DELETE FROM artifacts WHERE path = ?', removed)
+
+    def get_bytes(self, key):
+        with self.lock:
+            entry = self.memory.get(key)
+            if entry is None:
+                return None
+            self.memory.move_to_end(key)
+            entry['accessed'] = time.time()
+            return entry['data']
+
+    def put_bytes(self, key, data):
+        max_age = app.config['ARTIFACT_MAX_AGE']
+        with self.lock:
+            if key in self.memory:
+                self.memory_size -= len(self.memory.pop(key)['data'])
+            self.memory[key] = {'data': data, 'accessed': time.time()}
+            self.memory_size += len(data)
+            while len(self.memory) > 1:
+                entry = next(iter(self.memory.values()))
+                if self.memory_size <= app.config['ARTIFACT_MEMORY_BYTES'] and not (max_age and entry['accessed'] < time.time() - max_age):
+                    break
+                self.memory_size -= len(self.memory.popitem(last=False)[1]['data'])
+
+artifact_store = ArtifactStore()
+
+class ResultCache:
+    # LRU over response payloads, sized by their JSON; the chart files they reference are pinned in the artifact store.
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            payload = entry['payload']
+            # Lazy chart URLs render the dataset as it is now, so they go stale once batches are appended.
+            stale = payload.get('lazy_charts') and not upload_is_stored(payload['dataset_id'])
+            if stale or not all(artifact_store.available(path) for path in payload.get('visualizations', {}).values()):
+                self._discard(self.entries.pop(key))
+                return None
+            self.entries.move_to_end(key)
+        artifact_store.touch(path for path in entry['payload'].get('visualizations', {}).values() if artifact_store.owns(path))
+        return entry['payload']
+
+    def put(self, key, payload):
+        size = len(json.dumps(payload))
+        with self.lock:
+            if key in self.entries:
+                self._discard(self.entries.pop(key))
+            self.entries[key] = {'payload': payload, 'size': size}
+            self.size += size
+            while self.size > self.max_bytes and len(self.entries) > 1:
+                self._discard(self.entries.popitem(last=False)[1])
+        artifact_store.acquire(payload.get('visualizations', {}).values())
+
+    def _discard(self, entry):
+        self.size -= entry['size']
+        artifact_store.release(entry['payload'].get('visualizations', {}).values())
+
+result_cache = ResultCache(app.config['RESULT_CACHE_MAX_BYTES'])
+
+class AnalysisError(ValueError):
+    pass
+
+def dataset_path(dataset_id, *parts):
+    return os.path.join(app.config['DATASET_FOLDER'], dataset_id, *parts)
+
+def dataset_meta(dataset_id):
+    if not re.fullmatch(r'[0-9a-f]{64}', dataset_id):
+        return None
+    path = dataset_path(dataset_id, 'meta.json')
+    try:
+        with open(path) as f:
+            meta = json.load(f)
+        # meta.json's mtime is the dataset's last use, which orders eviction.
+        if time.time() - os.stat(path).st_mtime > 60:
+            os.utime(path)
+    except FileNotFoundError:
+        return None
+    return meta
+
+def dataset_size(dataset_id):
+    return sum(os.path.getsize(os.path.join(folder, name))
+               for folder, _, names in os.walk(dataset_path(dataset_id)) for name in names)
+
+def evict_datasets(keep=None):
+    # Stored datasets are copies of patient data, so they get the same kind of budget as chart artifacts:
+    # least recently used first once they exceed DATASET_MAX_BYTES, and any unused for DATASET_MAX_AGE.
+    max_bytes, max_age = app.config['DATASET_MAX_BYTES'], app.config['DATASET_MAX_AGE']
+    cutoff = time.time() - max_age if max_age else 0
+    datasets = []
+    for name in os.listdir(app.config['DATASET_FOLDER']):
+        try:
+            accessed = os.stat(dataset_path(name, 'meta.json')).st_mtime
+        except (FileNotFoundError, NotADirectoryError):
+            continue
+        if re.fullmatch(r'[0-9a-f]{64}', name):
+            datasets.append((accessed, name, dataset_size(name)))
+    total = sum(size for _, _, size in datasets)
+    for accessed, name, size in sorted(datasets):
+        if total <= max_bytes and accessed >= cutoff:
+            break
+        if name == keep:
+            continue
+        try:
+            with dataset_lock(name):
+                shutil.rmtree(dataset_path(name), ignore_errors=True)
+        except FileNotFoundError:
+            pass
+        total -= size
+
+def write_part(folder, df):
+    os.makedirs(folder)
+    categories = {}
+    for col in CATEGORICAL_COLUMNS:
+        values = df[col].astype('category')
+        categories[col] = values.cat.categories.tolist()
+        np.save(os.path.join(folder, f'{col}.npy'), values.cat.codes.to_numpy())
+    for col in DATE_COLUMNS:
+        np.save(os.path.join(folder, f'{col}.npy'), pd.to_datetime(df[col]).to_numpy(dtype='datetime64[ns]'))
+    np.save(os.path.join(folder, 'PatientID.npy'), patient_id_array(df['PatientID'].to_numpy()))
+    return {'name': os.path.basename(folder), 'rows': int(len(df)), 'categories': categories}
+
+class DatasetWriter:
+    # Parts are written to a staging directory that is renamed into place on commit,
+    # so concurrent readers never see a half-written dataset.
+    def __init__(self, dataset_id):
+        self.dataset_id = dataset_id
+        self.folder = os.path.join(app.config['DATASET_FOLDER'], f'.{dataset_id}.{uuid.uuid4().hex}')
+        self.parts = []
+        os.makedirs(self.folder)
+
+    def write(self, df):
+        self.parts.append(write_part(os.path.join(self.folder, f'part-{len(self.parts):05d}'), df))
+
+    def commit(self):
+        meta = {
+            'dataset_id': self.dataset_id,
+            'created': time.time(),
+            'rows': sum(part['rows'] for part in self.parts),
+            'appends': 0,
+            'parts': self.parts
+        }
+        with open(os.path.join(self.folder, 'meta.json'), 'w') as f:
+            json.dump(meta, f)
+        try:
+            os.rename(self.folder, dataset_path(self.dataset_id))
+        except OSError:
+            self.abort()
+        evict_datasets(keep=self.dataset_id)
+
+    def abort(self):
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+def store_dataset(dataset_id, df):
+    writer = DatasetWriter(dataset_id)
+    try:
+        writer.write(df)
+    except Exception:
+        writer.abort()
+        raise
+    writer.commit()
+
+def read_part_column(dataset_id, part, col):
+    values = np.load(dataset_path(dataset_id, part['name'], f'{col}.npy'), mmap_mode='r')
+    if col in CATEGORICAL_COLUMNS:
+        return pd.Categorical.from_codes(values, part['categories'][col])
+    return values
+
+def iter_dataset(dataset_id, columns=None):
+    for part in dataset_meta(dataset_id)['parts']:
+        yield pd.DataFrame({col: read_part_column(dataset_id, part, col) for col in columns or REQUIRED_COLUMNS}, copy=False)
+
+def load_dataset(dataset_id, columns=None):
+    parts = dataset_meta(dataset_id)['parts']
+    data = {}
+    for col in columns or REQUIRED_COLUMNS:
+        values = [read_part_column(dataset_id, part, col) for part in parts]
+        if col in CATEGORICAL_COLUMNS:
+            data[col] = union_categoricals(values)
+        else:
+            data[col] = values[0] if len(values) == 1 else np.concatenate(values)
+    return pd.DataFrame(data, copy=False)
+
+_dataset_locks = {}
+
+@contextmanager
+def dataset_lock(dataset_id):
+    lock = _dataset_locks.setdefault(dataset_id, threading.Lock())
+    with lock, open(dataset_path(dataset_id, '.lock'), 'w') as f:
+        if fcntl:
+            fcntl.flock(f, fcntl.LOCK_EX)
+        yield
+
+def replace_file(path, write):
+    with open(path + '.tmp', 'wb') as f:
+        write(f)
+    os.replace(path + '.tmp', path)
+
+def dataset_aggregates(dataset_id, meta=None):
+    # The cached aggregates are stamped with the append they include and rebuilt from the parts when stale.
+    version = (meta or dataset_meta(dataset_id)).get('appends', 0)
+    path = dataset_path(dataset_id, 'aggregates.pkl')
+    if os.path.exists(path):
+        cached = pd.read_pickle(path)
+        if isinstance(cached, dict) and cached.get('appends') == version:
+            return cached['aggregates']
+    aggregates = StayAggregates()
+    for part in iter_dataset(dataset_id, ANALYSIS_COLUMNS):
+        aggregates.update(part)
+    return aggregates
+
+def patient_id_text(value):
+    # Workbook cells hold numbers as floats; an integral float is the ID written without '.0'.
+    if value is None or (isinstance(value, float) and math.isnan(value)):
+        return None
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
+
+def patient_id_array(ids):
+    # IDs are stored and compared as text, with '' for a missing ID.
+    ids = np.asarray(ids)
+    if ids.dtype.kind == 'U':
+        return ids
+    if ids.dtype.kind in 'iub':
+        return ids.astype(str)
+    return np.array([patient_id_text(value) or '' for value in ids.tolist()], dtype=str)
+
+def load_id_run(dataset_id, run, mmap_mode=None):
+    ids = np.load(dataset_path(dataset_id, run['name']), mmap_mode=mmap_mode)
+    # Runs written before IDs were read as text hold numbers, sorted as numbers.
+    return ids if ids.dtype.kind == 'U' else np.sort(patient_id_array(ids))
+
+def write_id_run(dataset_id, ids):
+    name = f'ids-{uuid.uuid4().hex}.npy'
+    np.save(dataset_path(dataset_id, name), ids)
+    return {'name': name, 'rows': int(len(ids))}
+
+def merge_id_runs(dataset_id, runs):
+    # Sorted runs of known patient IDs, merged like an LSM tree: a run is folded into the one before it
+    # once they are of similar size, so each append costs about its batch size times log(total IDs).
+    runs = list(runs)
+    while len(runs) > 1 and runs[-2]['rows'] <= 2 * runs[-1]['rows']:
+        newer, older = runs.pop(), runs.pop()
+        ids = [load_id_run(dataset_id, run) for run in (older, newer)]
+        runs.append(write_id_run(dataset_id, np.sort(np.concatenate(ids), kind='stable')))
+    return runs
+
+def dataset_id_runs(dataset_id, meta):
+    if 'id_runs' in meta:
+        return meta['id_runs']
+    # Datasets stored before appends keep their IDs only in the parts.
+    ids = np.concatenate([patient_id_array(np.load(dataset_path(dataset_id, part['name'], 'PatientID.npy')))
+                          for part in meta['parts']])
+    return [write_id_run(dataset_id, np.unique(ids[ids != '']))]
+
+def new_patient_mask(batch, dataset_id, runs):
+    ids = patient_id_array(batch['PatientID'].to_numpy())
+    # Rows without an ID cannot be matched against earlier ones, so they are always kept.
+    missing = ids == ''
+    keep = ~pd.Series(ids).duplicated().to_numpy() | missing
+    for run in runs:
+        known_ids = load_id_run(dataset_id, run, mmap_mode='r')
+        if not len(known_ids):
+            continue
+        position = np.minimum(np.searchsorted(known_ids, ids), len(known_ids) - 1)
+        keep &= (known_ids[position] != ids) | missing
+    return keep, ids
+
+def remove_orphans(dataset_id, meta):
+    # Leftovers of an append that died before meta.json was replaced.
+    referenced = {part['name'] for part in meta['parts']} | {run['name'] for run in meta.get('id_runs', [])}
+    for name in os.listdir(dataset_path(dataset_id)):
+        if name.startswith(('part-', '.part-', 'ids-')) and name not in referenced:
+            path = dataset_path(dataset_id, name)
+            if os.path.isdir(path):
+                shutil.rmtree(path, ignore_errors=True)
+            else:
+                os.remove(path)
+
+def append_batch(dataset_id, batch):
+    # meta.json is the commit point: the new part and ID runs are written first under names nothing
+    # references yet, and the aggregates cache is stamped so a crash after the commit only makes it stale.
+    with dataset_lock(dataset_id):
+        meta = dataset_meta(dataset_id)
+        if meta is None:
+            raise AnalysisError('Dataset was evicted, upload it again')
+        remove_orphans(dataset_id, meta)
+        runs = dataset_id_runs(dataset_id, meta)
+        keep, ids = new_patient_mask(batch, dataset_id, runs)
+        batch = batch[keep]
+        aggregates = dataset_aggregates(dataset_id, meta)
+        if len(batch):
+            aggregates.update(batch)
+            name = f'part-{len(meta["parts"]):05d}'
+            staging = dataset_path(dataset_id, f'.{name}.{uuid.uuid4().hex}')
+            part = dict(write_part(staging, batch), name=name)
+            os.rename(staging, dataset_path(dataset_id, name))
+            runs = merge_id_runs(dataset_id, runs + [write_id_run(dataset_id, np.sort(ids[keep & (ids != '')]))])
+            meta['parts'].append(part)
+            meta['rows'] += part['rows']
+            meta['appends'] = meta.get('appends', 0) + 1
+        meta['id_runs'] = runs
+        replace_file(dataset_path(dataset_id, 'meta.json'), lambda f: f.write(json.dumps(meta).encode()))
+        replace_file(dataset_path(dataset_id, 'aggregates.pkl'),
+                     lambda f: pd.to_pickle({'appends': meta.get('appends', 0), 'aggregates': aggregates}, f))
+        remove_orphans(dataset_id, meta)
+        if os.path.exists(dataset_path(dataset_id, 'patient_ids.npy')):
+            os.remove(dataset_path(dataset_id, 'patient_ids.npy'))
+    evict_datasets(keep=dataset_id)
+    return aggregates, int(len(batch)), int((~keep).sum())
+
+def upload_is_stored(dataset_id):
+    # Once batches have been appended the dataset no longer matches the file it was created from.
+    meta = dataset_meta(dataset_id) if dataset_id else None
+    return meta is not None and not meta.get('appends')
+
+def load_frame(file, filename, dataset_id=None, sheet=None):
+    if upload_is_stored(dataset_id):
+        return load_dataset(dataset_id, ANALYSIS_COLUMNS)
+    df = load_upload(file, filename, sheet)
+    if dataset_id and app.config['DATASET_STORE']:
+        store_dataset(dataset_id, df)
+    return df
+
+def load_upload(file, filename, sheet=None):
+    if filename.endswith('.csv'):
+        return read_patient_csv(file)
+    elif filename.endswith(('.xls', '.xlsx')):
+        return read_patient_excel(file, filename, sheet)
+    raise AnalysisError('Unsupported file format')
+
+def analyze_stream(file, filename, dataset_id=None, report=None, sheet=None):
+    if upload_is_stored(dataset_id):
+        aggregates = StayAggregates()
+        for part in iter_dataset(dataset_id, ANALYSIS_COLUMNS):
+            aggregates.update(part)
+        return aggregates, None
+    if not filename.endswith('.csv'):
+        # Workbooks cannot be read in chunks; the converted sheet is stored so later runs stream from disk.
+        df = load_frame(file, filename, dataset_id, sheet)
+        return StayAggregates().update(df), df.attrs.get('ingest')
+    check_csv_columns(file)
+    started = time.perf_counter()
+    writer = DatasetWriter(dataset_id) if dataset_id and app.config['DATASET_STORE'] else None
+    try:
+        aggregates = analyze_csv_stream(file, report=report, writer=writer)
+    except Exception:
+        if writer:
+            writer.abort()
+        raise
+    if writer:
+        writer.commit()
+    return aggregates, ingest_stats(aggregates.rows, file_size(file), time.perf_counter() - started, 'c')
+
+def chart_urls(dataset_id):
+    return {name: f'/charts/{dataset_id}/{name}.png' for name in CHART_NAMES}
+
+class DatasetCache:
+    # LRU of values built from a dataset version, bounded by the config entry limit_key in units of weigh().
+    # The most recent value is always kept. Concurrent misses on one key wait for a single build.
+    def __init__(self, limit_key, weigh=lambda value: 1):
+        self.limit_key = limit_key
+        self.weigh = weigh
+        self.entries = OrderedDict()
+        self.building = {}
+        self.size = 0
+        self.lock = threading.Lock()
+
+    def get(self, key, build):
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                return self.entries[key][0]
+            pending = self.building.get(key)
+            owner = pending is None
+            if owner:
+                pending = self.building[key] = Future()
+        if not owner:
+            return pending.result()
+        try:
+            value = build()
+        except BaseException as e:
+            with self.lock:
+                del self.building[key]
+            pending.set_exception(e)
+            raise
+        weight = self.weigh(value)
+        with self.lock:
+            del self.building[key]
+            self.entries[key] = (value, weight)
+            self.size += weight
+            while self.size > app.config[self.limit_key] and len(self.entries) > 1:
+                self.size -= self.entries.popitem(last=False)[1][1]
+        pending.set_result(value)
+        return value
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+_chart_summaries = DatasetCache('CHART_SUMMARY_CACHE')
+
+def dataset_chart_summary(dataset_id, version):
+    def build():
+        with stage('chart.summary'):
+            return chart_summary(dataset_aggregates(dataset_id))
+    return _chart_summaries.get((dataset_id, version), build)
+
+_dataset_trends = DatasetCache('TREND_CACHE_BYTES', lambda cube: cube.nbytes)
+
+def dataset_trends(dataset_id, version):
+    def build():
+        with stage('trend.build', dataset_meta(dataset_id)['rows']):
+            return TrendCube(load_dataset(dataset_id, ANALYSIS_COLUMNS))
+    return _dataset_trends.get((dataset_id, version), build)
+
+_dataset_indexes = DatasetCache('QUERY_INDEX_CACHE_BYTES', lambda index: index.nbytes)
+
+def dataset_index(dataset_id, version):
+    def build():
+        with stage('query.build', dataset_meta(dataset_id)['rows']):
+            return DatasetIndex(load_dataset(dataset_id, ANALYSIS_COLUMNS))
+    return _dataset_indexes.get((dataset_id, version), build)
+
+def dataset_chart_task(dataset_id, version, chart):
+    if app.config['CHART_RENDERER'] == 'summary':
+        return summary_chart_tasks(dataset_chart_summary(dataset_id, version), dataset_id)[chart]
+    df = load_dataset(dataset_id, ANALYSIS_COLUMNS)
+    df['LengthOfStay'] = (df['DischargeDate'] - df['AdmissionDate']).dt.days
+    return seaborn_chart_tasks(df, dataset_id)[chart]
+
+def render_dataset_chart(dataset_id, chart, fmt, size=None, dpi=None):
+    meta = dataset_meta(dataset_id)
+    if meta is None:
+        return None
+    # Appends change the data, so they are part of the name; older renders are simply never asked for again.
+    version = meta.get('appends', 0)
+    dimensions = f'{size[0]:g}x{size[1]:g}' if size else 'default'
+    name = f'{chart}-{version}-{dimensions}-{dpi or "default"}.{fmt}'
+    if app.config['CHART_STORAGE'] != 'disk':
+        data = artifact_store.get_bytes(f'{dataset_id}/{name}')
+        if data is None:
+            render, summary, _ = dataset_chart_task(dataset_id, version, chart)
+            with stage(f'chart.{chart}'):
+                data = render(summary, ChartBuffer(fmt), size, dpi).getvalue()
+            artifact_store.put_bytes(f'{dataset_id}/{name}', data)
+        return io.BytesIO(data)
+    folder = os.path.join(app.config['UPLOAD_FOLDER'], 'charts', dataset_id)
+    path = os.path.join(folder, name)
+    if os.path.exists(path):
+        artifact_store.touch([path])
+        return os.path.abspath(path)
+    os.makedirs(folder, exist_ok=True)
+    render, data, _ = dataset_chart_task(dataset_id, version, chart)
+    staging = f'{path}.{uuid.uuid4().hex}.{fmt}'
+    with stage(f'chart.{chart}'):
+        render(data, staging, size, dpi)
+    os.replace(staging, path)
+    artifact_store.add([path])
+    return os.path.abspath(path)
+
+def run_analysis(file, filename, mode, file_prefix, dataset_id=None, report=None, render='server', sheet=None):
+    report = report or (lambda stage, rows=None: None)
+    if mode == 'stream':
+        aggregates, ingest = analyze_stream(file, filename, dataset_id, report, sheet)
+        payload = {
+            'success': True,
+            'dataset_id': dataset_id,
+            'ingest': ingest,
+            'analysis': aggregates.results()
+        }
+    else:
+        report('parsing')
+        df = load_frame(file, filename, dataset_id, sheet)
+        report('analyzing', len(df))
+        payload = {
+            'success': True,
+            'dataset_id': dataset_id,
+            'ingest': df.attrs.get('ingest'),
+            'analysis': analyze_data(df)
+        }
+    report('rendering', payload['analysis']['total_patients'])
+    if (render == 'server' and app.config['CHART_DELIVERY'] == 'lazy' and app.config['CHART_STORAGE'] != 'inline'
+            and upload_is_stored(dataset_id)):
+        payload['visualizations'] = chart_urls(dataset_id)
+        payload['lazy_charts'] = True
+    elif render == 'client':
+        if mode != 'stream':
+            with stage('chart.summary', len(df)):
+                aggregates = StayAggregates().update(df)
+        payload['visualizations'] = {}
+        payload['charts'] = chart_summary(aggregates)
+    elif mode == 'stream':
+        payload['visualizations'] = run_chart_tasks(summary_chart_tasks(chart_summary(aggregates), file_prefix))
+    else:
+        payload['visualizations'] = generate_visualizations(df, file_prefix)
+    return payload
+
+_shard_pool = None
+
+def shard_pool():
+    global _shard_pool
+    if _shard_pool is None:
+        _shard_pool = ProcessPoolExecutor(max_workers=app.config['SHARD_WORKERS'])
+    return _shard_pool
+
+def analyze_shard(path, filename):
+    try:
+        with open(path, 'rb') as file:
+            if filename.endswith('.csv'):
+                check_csv_columns(file)
+                return analyze_csv_stream(file)
+            return StayAggregates().update(load_frame(file, filename, file_digest(file)))
+    except AnalysisError as e:
+        raise AnalysisError(f'{filename}: {e}')
+    finally:
+        stage_metrics.flush()
+
+def batch_members(archive):
+    for info in archive.infolist():
+        name = os.path.basename(info.filename)
+        if not info.is_dir() and not name.startswith('.') and name.endswith(SUPPORTED_EXTENSIONS):
+            yield name, info
+
+def save_batch(files, folder):
+    saved = []
+    # Checked against the sizes the archives declare before anything is written; zipfile stops
+    # reading a member at its declared size, so a member cannot inflate past it.
+    extracted, limit = 0, app.config['BATCH_MAX_EXTRACTED_BYTES']
+    for file in files:
+        if file.filename.endswith('.zip'):
+            with zipfile.ZipFile(file) as archive:
+                members = list(batch_members(archive))
+                extracted += sum(info.file_size for _, info in members)
+                if limit is not None and extracted > limit:
+                    raise AnalysisError(f'{file.filename}: Archives expand to more than {limit} bytes')
+                for name, info in members:
+                    path = os.path.join(folder, f'{len(saved):05d}-{name}')
+                    with archive.open(info) as src, open(path, 'wb') as dst:
+                        shutil.copyfileobj(src, dst)
+                    saved.append((name, path))
+        elif file.filename.endswith(SUPPORTED_EXTENSIONS):
+            path = os.path.join(folder, f'{len(saved):05d}-{os.path.basename(file.filename)}')
+            file.save(path)
+            saved.append((file.filename, path))
+        else:
+            raise AnalysisError(f'{file.filename}: Unsupported file format')
+    return saved
+
+def site_names(filenames):
+    names = {}
+    for filename in filenames:
+        site = os.path.splitext(os.path.basename(filename))[0]
+        names[site] = names.get(site, 0) + 1
+        yield site if names[site] == 1 else f'{site} ({names[site]})'
+
+def run_batch_analysis(saved, file_prefix, per_site=False, render='server'):
+    with stage('batch.shards') as span:
+        futures = [shard_pool().submit(analyze_shard, path, name) for name, path in saved]
+        shards = [future.result() for future in futures]
+        span['rows'] = sum(shard.rows for shard in shards)
+    payload = {'success': True, 'files': len(shards)}
+    if per_site:
+        payload['sites'] = {site: shard.results() for site, shard in zip(site_names(name for name, _ in saved), shards)}
+    merged = reduce(StayAggregates.merge, shards, StayAggregates())
+    payload['analysis'] = merged.results()
+    summary = chart_summary(merged)
+    if render == 'client':
+        payload['visualizations'] = {}
+        payload['charts'] = summary
+    else:
+        payload['visualizations'] = run_chart_tasks(summary_chart_tasks(summary, file_prefix))
+    return payload
+
+# Futures of the jobs this process submitted, for the queue limit and history. Their state is
+# mirrored into job records under JOB_FOLDER so any worker process can answer /jobs/<id>.
+jobs = OrderedDict()
+jobs_lock = threading.Lock()
+_job_records_lock = threading.Lock()
+_job_pool = None
+
+def job_pool():
+    global _job_pool
+    if _job_pool is None:
+        _job_pool = ProcessPoolExecutor(max_workers=app.config['JOB_WORKERS'])
+    return _job_pool
+
+def job_path(job_id, suffix='json'):
+    return os.path.join(app.config['JOB_FOLDER'], f'{job_id}.{suffix}')
+
+def read_job(job_id):
+    if not re.fullmatch(r'[0-9a-f]{32}', job_id):
+        return None
+    try:
+        with open(job_path(job_id)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+def write_file(path, data):
+    staging = f'{path}.{uuid.uuid4().hex}.tmp'
+    with open(staging, 'w') as f:
+        f.write(data)
+    os.replace(staging, path)
+
+def write_job(job_id, **fields):
+    # Writers of one record are the submitting process and, for analysis jobs, the pool process
+    # running it; the pool process is finished before the submitting process writes the outcome.
+    with _job_records_lock:
+        record = read_job(job_id) or {'job_id': job_id}
+        record.update(fields)
+        write_file(job_path(job_id), json.dumps(record))
+
+def remove_job(job_id):
+    for path in (job_path(job_id), job_path(job_id, 'result.json')):
+        if os.path.exists(path):
+            os.remove(path)
+
+def run_analysis_job(job_id, path, filename, mode, render, file_prefix, dataset_id, sheet):
+    def report(stage, rows=None):
+        write_job(job_id, status='running', progress={'stage': stage, 'rows': rows})
+    try:
+        with open(path, 'rb') as file:
+            return run_analysis(file, filename, mode, file_prefix, dataset_id, report, render, sheet)
+    finally:
+        os.remove(path)
+        stage_metrics.flush()
+
+def finish_job(job_id, cache_key, submitted, future):
+    stage_metrics.observe('job', time.perf_counter() - submitted)
+    error = future.exception()
+    if error is not None:
+        write_job(job_id, status='failed', error=str(error), error_status=400 if isinstance(error, AnalysisError) else 500)
+        return
+    payload = future.result()
+    write_file(job_path(job_id, 'result.json'), json.dumps(payload))
+    write_job(job_id, status='done')
+    result_cache.put(cache_key, payload)
+
+def job_futures(job):
+    return list(job['charts'].values()) if 'charts' in job else [job['future']]
+
+def job_done(job):
+    return all(future.done() for future in job_futures(job))
+
+def add_job(job_id, job):
+    # Callers hold jobs_lock.
+    jobs[job_id] = job
+    while len(jobs) > app.config['JOB_HISTORY']:
+        oldest = next(iter(jobs))
+        if not job_done(jobs[oldest]):
+            break
+        del jobs[oldest]
+        remove_job(oldest)
+
+def submit_job(file, mode, render, cache_key, dataset_id, sheet=None):
+    pool = job_pool()
+    job_id = uuid.uuid4().hex
+    path = os.path.join(app.config['JOB_FOLDER'], job_id + os.path.splitext(file.filename)[1])
+    file.save(path)
+    # The queue check and the insert happen under one lock so concurrent uploads cannot overshoot the limit.
+    with jobs_lock:
+        pending = sum(1 for job in jobs.values() if not job_done(job))
+        if pending >= app.config['JOB_QUEUE_LIMIT']:
+            os.remove(path)
+            return None
+        write_job(job_id, kind='analysis', status='queued', progress={'stage': 'queued', 'rows': None}, created=time.time())
+        future = pool.submit(run_analysis_job, job_id, path, file.filename, mode, render, cache_key, dataset_id, sheet)
+        add_job(job_id, {'future': future, 'created': time.time()})
+    future.add_done_callback(partial(finish_job, job_id, cache_key, time.perf_counter()))
+    return job_id
+
+def cache_chart_job(cache_key, dataset_id, analysis, futures):
+    if all(future.done() and future.exception() is None for future in futures.values()):
+        result_cache.put(cache_key, {
+            'success': True,
+            'dataset_id': dataset_id,
+            'analysis': analysis,
+            'visualizations': {name: chart_reference(future.result()) for name, future in futures.items()}
+        })
+
+def record_chart_job(job_id, futures):
+    done = {name: future for name, future in futures.items() if future.done()}
+    errors = [future.exception() for future in done.values() if future.exception() is not None]
+    write_job(job_id,
+              status='failed' if errors else 'done' if len(done) == len(futures) else 'running',
+              progress={'stage': 'rendering', 'charts_done': len(done), 'charts_total': len(futures)},
+              visualizations={name: chart_reference(future.result()) for name, future in done.items() if future.exception() is None},
+              **({'error': str(errors[0]), 'error_status': 500} if errors else {}))
+
+def submit_chart_job(df, cache_key, dataset_id, analysis):
+    job_id = uuid.uuid4().hex
+    tasks = chart_tasks(df, cache_key)
+    write_job(job_id, kind='charts', status='running', created=time.time(),
+              progress={'stage': 'rendering', 'charts_done': 0, 'charts_total': len(tasks)}, visualizations={})
+    futures = submit_charts(tasks)
+    for future in futures.values():
+        future.add_done_callback(lambda f: record_chart_job(job_id, futures))
+        future.add_done_callback(lambda f: cache_chart_job(cache_key, dataset_id, analysis, futures))
+    with jobs_lock:
+        add_job(job_id, {'charts': futures, 'created': time.time()})
+    return job_id
+
+def job_status(record):
+    status = {key: record[key] for key in ('job_id', 'status', 'progress', 'visualizations') if key in record}
+    status['elapsed'] = round(time.time() - record['created'], 2)
+    return status
+
+def warm_up():
+    # Called by the serving parent before it forks workers, so they inherit the imported
+    # modules, matplotlib's font cache and seaborn instead of each paying for them.
+    import seaborn as sns
+    sns.axes_style()
+    summary = chart_summary(StayAggregates().update(pd.DataFrame({
+        'BloodType': BLOOD_TYPES,
+        'Diagnosis': ['Warm-up'] * len(BLOOD_TYPES),
+        'AdmissionDate': pd.to_datetime(['2024-01-01'] * len(BLOOD_TYPES)),
+        'DischargeDate': pd.to_datetime([f'2024-01-0{i + 2}' for i in range(len(BLOOD_TYPES))])
+    })))
+    for render, data, _ in summary_chart_tasks(summary, 'warm-up').values():
+        render(data, ChartBuffer())
+    render_histogram_chart(pd.Series(range(10)), ChartBuffer())
+
+_request_slots = None
+
+def request_slots():
+    global _request_slots
+    if _request_slots is None:
+        _request_slots = threading.BoundedSemaphore(app.config['MAX_CONCURRENT_REQUESTS'])
+    return _request_slots
+
+@app.before_request
+def limit_concurrent_requests():
+    if not app.config['MAX_CONCURRENT_REQUESTS'] or request.endpoint == 'metrics':
+        return None
+    if not request_slots().acquire(blocking=False):
+        return jsonify({'error': 'Server busy, try again later'}), 503
+    g.request_slot = True
+
+@app.teardown_request
+def release_request_slot(error=None):
+    if g.pop('request_slot', False):
+        request_slots().release()
+
+@app.errorhandler(413)
+def upload_too_large(error):
+    limit = app.config['MAX_CONTENT_LENGTH']
+    if limit is not None and (request.content_length is None or request.content_length > limit):
+        return jsonify({'error': f'Upload exceeds the {limit / (1024 * 1024):g} MB limit'}), 413
+    # Werkzeug also answers 413 for form fields over MAX_FORM_MEMORY_SIZE and forms over MAX_FORM_PARTS.
+    return jsonify({'error': f"Form data exceeds the limit of {app.config.get('MAX_FORM_MEMORY_SIZE')} bytes per field "
+                             f"or {app.config.get('MAX_FORM_PARTS')} parts"}), 413
+
+@app.before_request
+def start_request_profile():
+    g.request_started = time.perf_counter()
+    if app.config['PROFILE_REQUESTS'] and request.args.get('profile') in ('1', 'true'):
+        g.profiler = cProfile.Profile()
+        g.profiler.enable()
+
+@app.after_request
+def finish_request_profile(response):
+    profiler = g.pop('profiler', None)
+    if profiler is not None:
+        profiler.disable()
+        os.makedirs(app.config['PROFILE_FOLDER'], exist_ok=True)
+        path = os.path.join(app.config['PROFILE_FOLDER'],
+                            f'{request.endpoint}-{time.strftime("%Y%m%d-%H%M%S")}-{uuid.uuid4().hex[:8]}.prof')
+        profiler.dump_stats(path)
+        response.headers['X-Profile-Dump'] = path
+    if request.endpoint and 'request_started' in g:
+        stage_metrics.observe(f'request.{request.endpoint}', time.perf_counter() - g.request_started)
+        stage_metrics.flush()
+    return response
+
+@app.route('/metrics')
+def metrics():
+    return Response(stage_metrics.render(), mimetype='text/plain; version=0.0.4')
+
 @app.route('/')
 def index():
     return render_template_string('''
@@ -107,6 +1980,8 @@ def index():
     <title>Blood Type Analysis</title>
     <link href="https://cdn.jsdelivr.net/npm/bootstrap@5.3.0/dist/css/bootstrap.min.css" rel="stylesheet">
     <link rel="stylesheet" href="https://cdn.jsdelivr.net/npm/bootstrap-icons@1.10.0/font/bootstrap-icons.css">
+    <script src="https://cdn.jsdelivr.net/npm/chart.js@4.4.0/dist/chart.umd.min.js"></script>
+    <script src="https://cdn.jsdelivr.net/npm/@sgratzl/chartjs-chart-boxplot@4.2.4/build/index.umd.min.js"></script>
     <style>
         body{font-family:'Segoe UI',Tahoma,Geneva,Verdana,sans-serif;background-color:#f8f9fa;color:#333}
         .navbar-brand{font-weight:700}
@@ -152,7 +2027,7 @@ def index():
                 <div class="spinner-border text-danger" role="status">
                     <span class="visually-hidden">Loading...</span>
                 </div>
-                <p class="mt-2">Analyzing blood type patterns...</p>
+                <p class="mt-2" id="loadingStatus">Analyzing blood type patterns...</p>
             </div>
             <div class="alert alert-danger mt-3 d-none" id="errorAlert" role="alert"></div>
         </div>
@@ -242,12 +2117,14 @@ def index():
                             <div class="visualization">
                                 <h5><i class="bi bi-droplet text-danger"></i> Hospital Stay by Blood Type</h5>
                                 <img id="bloodTypeImg" src="" alt="Hospital Stay by Blood Type" class="img-fluid">
+                                <canvas id="bloodTypeChart" class="d-none"></canvas>
                             </div>
                         </div>
                         <div class="col-md-6">
                             <div class="visualization">
                                 <h5><i class="bi bi-pie-chart text-danger"></i> Blood Type Distribution</h5>
                                 <img id="pieImg" src="" alt="Blood Type Distribution" class="img-fluid">
+                                <canvas id="pieChart" class="d-none"></canvas>
                             </div>
                         </div>
                     </div>
@@ -256,12 +2133,14 @@ def index():
                             <div class="visualization">
                                 <h5><i class="bi bi-clipboard2-pulse text-danger"></i> Top Diagnoses by Blood Type</h5>
                                 <img id="bloodDiagImg" src="" alt="Top Diagnoses by Blood Type" class="img-fluid">
+                                <canvas id="bloodDiagChart" class="d-none"></canvas>
                             </div>
                         </div>
                         <div class="col-md-6">
                             <div class="visualization">
                                 <h5><i class="bi bi-bar-chart text-danger"></i> Hospital Stay Distribution</h5>
                                 <img id="histogramImg" src="" alt="Hospital Stay Distribution" class="img-fluid">
+                                <canvas id="histogramChart" class="d-none"></canvas>
                             </div>
                         </div>
                     </div>
@@ -280,6 +2159,7 @@ def index():
             const dropZone = document.getElementById('dropZone');
             const fileInput = document.getElementById('fileInput');
             const loadingSpinner = document.getElementById('loadingSpinner');
+            const loadingStatus = document.getElementById('loadingStatus');
             const errorAlert = document.getElementById('errorAlert');
             const analysisResults = document.getElementById('analysisResults');
             const useSampleDataBtn = document.getElementById('useSampleData');
@@ -340,16 +2220,14 @@ def index():
                 errorAlert.classList.add('d-none');
                 const formData = new FormData();
                 formData.append('file', file);
+                formData.append('async', '1');
+                formData.append('render', 'client');
                 fetch('/upload', {
                     method: 'POST',
                     body: formData
                 })
-                .then(response => {
-                    if (!response.ok) {
-                        return response.json().then(err => { throw new Error(err.error); });
-                    }
-                    return response.json();
-                })
+                .then(parseResponse)
+                .then(data => data.job_id ? pollJob(data.job_id) : data)
                 .then(data => {
                     if (data.error) {
                         throw new Error(data.error);
@@ -361,9 +2239,33 @@ def index():
                 })
                 .finally(() => {
                     loadingSpinner.style.display = 'none';
+                    loadingStatus.textContent = 'Analyzing blood type patterns...';
                 });
             }
             
+            function parseResponse(response) {
+                if (!response.ok) {
+                    return response.json().then(err => { throw new Error(err.error); });
+                }
+                return response.json();
+            }
+            
+            function pollJob(jobId) {
+                return new Promise(resolve => setTimeout(resolve, 1000))
+                    .then(() => fetch(`/jobs/${jobId}`))
+                    .then(parseResponse)
+                    .then(job => {
+                        if (job.status === 'done' || job.status === 'failed') {
+                            return fetch(`/jobs/${jobId}/result`).then(parseResponse);
+                        }
+                        const progress = job.progress || {};
+                        loadingStatus.textContent = progress.rows
+                            ? `Analyzing blood type patterns... (${progress.stage}, ${progress.rows} rows)`
+                            : 'Analyzing blood type patterns...';
+                        return pollJob(jobId);
+                    });
+            }
+            
             useSampleDataBtn.addEventListener('click', function() {
                 loadingSpinner.style.display = 'block';
                 errorAlert.classList.add('d-none');
@@ -398,6 +2300,70 @@ def index():
                 errorAlert.classList.remove('d-none');
             }
             
+            const chartInstances = {};
+            
+            function drawChart(id, config) {
+                const canvas = document.getElementById(id);
+                canvas.classList.remove('d-none');
+                canvas.previousElementSibling.classList.add('d-none');
+                if (chartInstances[id]) chartInstances[id].destroy();
+                chartInstances[id] = new Chart(canvas, config);
+            }
+            
+            function boxItem(box) {
+                return box ? {min: box.whislo, q1: box.q1, median: box.med, q3: box.q3, max: box.whishi, outliers: box.fliers} : null;
+            }
+            
+            function drawCharts(charts) {
+                drawChart('bloodTypeChart', {
+                    type: 'boxplot',
+                    data: {
+                        labels: charts.blood_type.map(box => box.label),
+                        datasets: [{label: 'Days in Hospital', data: charts.blood_type.map(boxItem)}]
+                    },
+                    options: {plugins: {legend: {display: false}}}
+                });
+                
+                const diagnoses = charts.blood_diagnosis.diagnoses;
+                drawChart('bloodDiagChart', {
+                    type: 'boxplot',
+                    data: {
+                        labels: diagnoses,
+                        datasets: charts.blood_diagnosis.blood_types.map(bt => ({
+                            label: bt,
+                            data: diagnoses.map(d => boxItem(charts.blood_diagnosis.boxes.find(box => box.label[0] === d && box.label[1] === bt)))
+                        }))
+                    }
+                });
+                
+                const hist = charts.histogram;
+                drawChart('histogramChart', {
+                    type: 'bar',
+                    data: {
+                        datasets: [
+                            {
+                                label: 'Number of Patients',
+                                data: hist.counts.map((count, i) => ({x: (hist.edges[i] + hist.edges[i + 1]) / 2, y: count})),
+                                barPercentage: 1,
+                                categoryPercentage: 1
+                            },
+                            {
+                                type: 'line',
+                                label: 'Density',
+                                data: hist.kde_x.map((x, i) => ({x: x, y: hist.kde_y[i]})),
+                                pointRadius: 0
+                            }
+                        ]
+                    },
+                    options: {scales: {x: {type: 'linear', title: {display: true, text: 'Days'}}}}
+                });
+                
+                drawChart('pieChart', {
+                    type: 'pie',
+                    data: {labels: charts.pie.labels, datasets: [{data: charts.pie.counts}]}
+                });
+            }
+            
             function displayResults(data) {
                 analysisResults.classList.remove('d-none');
                 const analysis = data.analysis;
@@ -408,10 +2374,18 @@ def index():
                 document.getElementById('medianStay').textContent = analysis.median_stay;
                 document.getElementById('stayRange').textContent = `${analysis.min_stay} - ${analysis.max_stay}`;
                 
-                document.getElementById('bloodTypeImg').src = visualizations.blood_type;
-                document.getElementById('bloodDiagImg').src = visualizations.blood_diagnosis;
-                document.getElementById('histogramImg').src = visualizations.histogram;
-                document.getElementById('pieImg').src = visualizations.pie;
+                if (data.charts) {
+                    drawCharts(data.charts);
+                } else {
+                    document.querySelectorAll('.visualization canvas').forEach(canvas => {
+                        canvas.classList.add('d-none');
+                        canvas.previousElementSibling.classList.remove('d-none');
+                    });
+                }
+                if (visualizations.blood_type) document.getElementById('bloodTypeImg').src = visualizations.blood_type;
+                if (visualizations.blood_diagnosis) document.getElementById('bloodDiagImg').src = visualizations.blood_diagnosis;
+                if (visualizations.histogram) document.getElementById('histogramImg').src = visualizations.histogram;
+                if (visualizations.pie) document.getElementById('pieImg').src = visualizations.pie;
                 
                 let bloodTypeTableHtml = '';
                 for (const bloodType in analysis.blood_type_stats.mean) {
@@ -481,28 +2455,242 @@ def upload_file():
         return jsonify({'error': 'No selected file'}), 400
     if file:
         try:
-            file_prefix = str(uuid.uuid4())
-            if file.filename.endswith('.csv'):
-                df = pd.read_csv(file)
-            elif file.filename.endswith(('.xls', '.xlsx')):
-                df = pd.read_excel(file)
-            else:
-                return jsonify({'error': 'Unsupported file format'}), 400
-            
-            required_columns = ['PatientID', 'BloodType', 'Diagnosis', 'AdmissionDate', 'DischargeDate']
-            if not all(col in df.columns for col in required_columns):
-                return jsonify({'error': f'Missing required columns: {", ".join(required_columns)}'}), 400
-            
-            analysis_results = analyze_data(df)
-            visualizations = generate_visualizations(df, file_prefix)
-            
-            return jsonify({
-                'success': True,
-                'analysis': analysis_results,
-                'visualizations': visualizations
-            })
+            mode = request.values.get('mode', 'full')
+            render = request.values.get('render', 'server')
+            sheet = request.values.get('sheet')
+            with stage('upload.hash'):
+                dataset_id = excel_dataset_id(file_digest(file), file.filename, sheet)
+            cache_key = result_cache_key(dataset_id, mode, render)
+            cached = result_cache.get(cache_key)
+            if cached is not None:
+                return jsonify(cached)
+            if request.values.get('async') in ('1', 'true'):
+                job_id = submit_job(file, mode, render, cache_key, dataset_id, sheet)
+                if job_id is None:
+                    return jsonify({'error': 'Too many pending jobs, try again later'}), 503
+                return jsonify(job_status(read_job(job_id))), 202
+            if request.values.get('charts') == 'deferred' and mode != 'stream' and render != 'client':
+                df = load_frame(file, file.filename, dataset_id, sheet)
+                analysis_results = analyze_data(df)
+                return jsonify({
+                    'success': True,
+                    'dataset_id': dataset_id,
+                    'analysis': analysis_results,
+                    'visualizations': {},
+                    'chart_job': submit_chart_job(df, cache_key, dataset_id, analysis_results)
+                })
+            payload = run_analysis(file, file.filename, mode, cache_key, dataset_id, render=render, sheet=sheet)
+            result_cache.put(cache_key, payload)
+            return jsonify(payload)
+        except AnalysisError as e:
+            return jsonify({'error': str(e)}), 400
         except Exception as e:
             return jsonify({'error': str(e)}), 500
 
+@app.route('/upload/batch', methods=['POST'])
+def upload_batch():
+    files = [file for file in request.files.getlist('files') + request.files.getlist('file') if file.filename]
+    if not files:
+        return jsonify({'error': 'No file uploaded'}), 400
+    per_site = request.values.get('per_site') in ('1', 'true')
+    render = request.values.get('render', 'server')
+    try:
+        with tempfile.TemporaryDirectory(dir=app.config['JOB_FOLDER']) as folder:
+            saved = save_batch(files, folder)
+            if not saved:
+                return jsonify({'error': 'No CSV or Excel files found in upload'}), 400
+            with stage('upload.hash'):
+                digests = []
+                for name, path in saved:
+                    with open(path, 'rb') as f:
+                        digests.append(f'{name}:{file_digest(f)}')
+            cache_key = result_cache_key(hashlib.sha256('\n'.join(digests).encode()).hexdigest(), f'batch:{per_site}', render)
+            cached = result_cache.get(cache_key)
+            if cached is not None:
+                return jsonify(cached)
+            payload = run_batch_analysis(saved, cache_key, per_site, render)
+        result_cache.put(cache_key, payload)
+        return jsonify(payload)
+    except (AnalysisError, zipfile.BadZipFile) as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/datasets/<dataset_id>/analyze', methods=['GET', 'POST'])
+def analyze_dataset(dataset_id):
+    if dataset_meta(dataset_id) is None:
+        return jsonify({'error': 'Unknown dataset'}), 404
+    try:
+        df = load_dataset(dataset_id, ANALYSIS_COLUMNS)
+        return jsonify({
+            'success': True,
+            'dataset_id': dataset_id,
+            'analysis': analyze_data(df),
+            'visualizations': chart_urls(dataset_id)
+        })
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/datasets/<dataset_id>/significance')
+def dataset_significance(dataset_id):
+    meta = dataset_meta(dataset_id)
+    if meta is None:
+        return jsonify({'error': 'Unknown dataset'}), 404
+    resamples = request.args.get('resamples', app.config['STATS_RESAMPLES'], type=int)
+    seed = request.args.get('seed', app.config['STATS_SEED'], type=int)
+    if not 1 <= resamples <= 100000:
+        return jsonify({'error': 'resamples must be between 1 and 100000'}), 400
+    if seed < 0:
+        return jsonify({'error': 'seed must be a non-negative integer'}), 400
+    settings = f"{resamples}:{seed}:{app.config['STATS_CONFIDENCE']}:{app.config['STATS_CORRECTION']}:{app.config['STATS_MIN_COUNT']}"
+    cache_key = result_cache_key(dataset_id, f"significance:{meta.get('appends', 0)}:{settings}")
+    cached = result_cache.get(cache_key)
+    if cached is not None:
+        return jsonify(cached)
+    try:
+        payload = {
+            'success': True,
+            'dataset_id': dataset_id,
+            'significance': significance_tests(dataset_aggregates(dataset_id), resamples, seed)
+        }
+    except AnalysisError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+    result_cache.put(cache_key, payload)
+    return jsonify(payload)
+
+@app.route('/datasets/<dataset_id>/trend')
+def dataset_trend(dataset_id):
+    meta = dataset_meta(dataset_id)
+    if meta is None:
+        return jsonify({'error': 'Unknown dataset'}), 404
+    try:
+        start, end = (np.datetime64(request.args[name], 'D') if request.args.get(name) else None for name in ('start', 'end'))
+    except ValueError:
+        return jsonify({'error': 'start and end must be dates (YYYY-MM-DD)'}), 400
+    try:
+        trends = dataset_trends(dataset_id, meta.get('appends', 0))
+        with stage('trend.query'):
+            trend = trends.query(request.args.get('granularity', 'month'), start, end,
+                                 request.args.getlist('blood_type'), request.args.getlist('diagnosis'), request.args.get('by'))
+    except AnalysisError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+    return jsonify(dict(trend, success=True, dataset_id=dataset_id))
+
+@app.route('/datasets/<dataset_id>/query', methods=['GET', 'POST'])
+def query_dataset(dataset_id):
+    meta = dataset_meta(dataset_id)
+    if meta is None:
+        return jsonify({'error': 'Unknown dataset'}), 404
+    params = request.get_json(silent=True) if request.is_json else {}
+    if not isinstance(params, dict):
+        return jsonify({'error': 'Request body must be a JSON object'}), 400
+
+    def values(name):
+        found = params.get(name, request.values.getlist(name))
+        found = [found] if isinstance(found, str) else found
+        if not isinstance(found, list) or not all(isinstance(item, str) for item in found):
+            raise AnalysisError(f'{name} must be a string or a list of strings')
+        return found
+
+    def single(name):
+        found = params.get(name, request.values.get(name))
+        if found is not None and not isinstance(found, str):
+            raise AnalysisError(f'{name} must be a string')
+        return found or None
+
+    try:
+        filters = {'blood_types': values('blood_type'), 'diagnoses': values('diagnosis'), 'rh': single('rh')}
+        for name in ('start', 'end'):
+            filters[name] = np.datetime64(single(name), 'D') if single(name) else None
+    except AnalysisError as e:
+        return jsonify({'error': str(e)}), 400
+    except ValueError:
+        return jsonify({'error': 'start and end must be dates (YYYY-MM-DD)'}), 400
+    try:
+        rows, analysis = dataset_index(dataset_id, meta.get('appends', 0)).query(**filters)
+    except AnalysisError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+    return jsonify({
+        'success': True,
+        'dataset_id': dataset_id,
+        'filters': {name: str(value) if isinstance(value, np.datetime64) else value for name, value in filters.items()},
+        'rows': int(len(rows)),
+        'analysis': analysis
+    })
+
+@app.route('/datasets/<dataset_id>/append', methods=['POST'])
+def append_dataset(dataset_id):
+    if dataset_meta(dataset_id) is None:
+        return jsonify({'error': 'Unknown dataset'}), 404
+    if 'file' not in request.files:
+        return jsonify({'error': 'No file uploaded'}), 400
+    file = request.files['file']
+    if file.filename == '':
+        return jsonify({'error': 'No selected file'}), 400
+    try:
+        aggregates, appended, duplicates = append_batch(dataset_id, load_upload(file, file.filename, request.values.get('sheet')))
+        return jsonify({
+            'success': True,
+            'dataset_id': dataset_id,
+            'appended': appended,
+            'duplicates': duplicates,
+            'analysis': aggregates.results(),
+            'visualizations': chart_urls(dataset_id)
+        })
+    except AnalysisError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/charts/<dataset_id>/<chart>.<fmt>')
+def dataset_chart(dataset_id, chart, fmt):
+    if chart not in CHART_NAMES or fmt not in CHART_FORMATS:
+        return jsonify({'error': 'Unknown chart'}), 404
+    try:
+        width = request.args.get('width', type=float)
+        height = request.args.get('height', type=float)
+        dpi = request.args.get('dpi', type=int)
+        if (width is None) != (height is None):
+            raise AnalysisError('width and height must be given together')
+        if width is not None and not (1 <= width <= 40 and 1 <= height <= 40):
+            raise AnalysisError('width and height must be between 1 and 40 inches')
+        if dpi is not None and not 10 <= dpi <= 600:
+            raise AnalysisError('dpi must be between 10 and 600')
+        image = render_dataset_chart(dataset_id, chart, fmt, (width, height) if width else None, dpi)
+    except AnalysisError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+    if image is None:
+        return jsonify({'error': 'Dataset not found'}), 404
+    return send_file(image, mimetype=CHART_FORMATS[fmt])
+
+@app.route('/jobs/<job_id>')
+def get_job(job_id):
+    record = read_job(job_id)
+    if record is None:
+        return jsonify({'error': 'Unknown job'}), 404
+    return jsonify(job_status(record))
+
+@app.route('/jobs/<job_id>/result')
+def get_job_result(job_id):
+    record = read_job(job_id)
+    if record is None:
+        return jsonify({'error': 'Unknown job'}), 404
+    if record['status'] in ('queued', 'running'):
+        return jsonify(job_status(record)), 202
+    if record['status'] == 'failed':
+        return jsonify({'error': record['error']}), record['error_status']
+    if record['kind'] == 'charts':
+        return jsonify({'success': True, 'visualizations': record['visualizations']})
+    with open(job_path(job_id, 'result.json')) as f:
+        return Response(f.read(), mimetype='application/json')
+
 if __name__ == '__main__':
     app.run(debug=True)
\ No newline at end of file
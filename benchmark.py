@@ -0,0 +1,185 @@
+import argparse
+import io
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+import app as blood_app
+
+BLOOD_TYPE_FREQUENCIES = {
+    'O+': 0.374, 'A+': 0.357, 'B+': 0.085, 'O-': 0.066,
+    'A-': 0.063, 'AB+': 0.034, 'B-': 0.015, 'AB-': 0.006
+}
+COMMON_DIAGNOSES = [
+    'Pneumonia', 'Heart Failure', 'Sepsis', 'COVID-19', 'Diabetes', 'Stroke', 'Fracture',
+    'Appendicitis', 'COPD', 'Kidney Injury', 'Cellulitis', 'Asthma', 'Pancreatitis',
+    'Gastroenteritis', 'Myocardial Infarction', 'Urinary Tract Infection', 'Cholecystitis',
+    'Pulmonary Embolism', 'Anemia', 'Migraine'
+]
+DEFAULT_SIZES = [10 ** 3, 10 ** 4, 10 ** 5, 10 ** 6]
+
+def generate_patients(rows, seed=0, diagnoses=500, start='2020-01-01', days=3 * 365):
+    rng = np.random.default_rng(seed)
+    blood_types = rng.choice(list(BLOOD_TYPE_FREQUENCIES), size=rows, p=list(BLOOD_TYPE_FREQUENCIES.values()))
+
+    labels = COMMON_DIAGNOSES + [f'Condition {i:03d}' for i in range(len(COMMON_DIAGNOSES), diagnoses)]
+    weights = 1.0 / np.arange(1, len(labels) + 1) ** 1.1
+    diagnosis_codes = rng.choice(len(labels), size=rows, p=weights / weights.sum())
+    typical_stay = rng.uniform(1.0, 2.3, size=len(labels))
+
+    admission = np.datetime64(start, 'D') + rng.integers(0, days, size=rows).astype('timedelta64[D]')
+    stay = np.rint(rng.lognormal(typical_stay[diagnosis_codes], 0.6)).astype('timedelta64[D]')
+    return pd.DataFrame({
+        'PatientID': np.arange(1, rows + 1),
+        'BloodType': blood_types,
+        'Diagnosis': pd.Categorical.from_codes(diagnosis_codes, labels),
+        'AdmissionDate': admission.astype(str),
+        'DischargeDate': (admission + stay).astype(str)
+    })
+
+def measure(fn, repeat):
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = fn()
+        timings.append(time.perf_counter() - started)
+    tracemalloc.start()
+    fn()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return result, min(timings), peak
+
+def stages(csv_bytes, folder):
+    def parse():
+        return blood_app.read_patient_csv(io.BytesIO(csv_bytes))
+
+    def parse_untyped():
+        return pd.read_csv(io.BytesIO(csv_bytes))
+
+    raw = parse_untyped()
+
+    def dates():
+        return {col: pd.to_datetime(raw[col]) for col in blood_app.DATE_COLUMNS}
+
+    df = parse()
+    df['LengthOfStay'] = (df['DischargeDate'] - df['AdmissionDate']).dt.days
+    aggregates = blood_app.StayAggregates().update(df)
+    summary = blood_app.chart_summary(aggregates)
+
+    def upload():
+        blood_app.result_cache.entries.clear()
+        blood_app.result_cache.size = 0
+        with tempfile.TemporaryDirectory(dir=folder) as datasets:
+            blood_app.app.config['DATASET_FOLDER'] = datasets
+            response = blood_app.app.test_client().post(
+                '/upload', data={'file': (io.BytesIO(csv_bytes), 'benchmark.csv')})
+        assert response.status_code == 200, response.get_json()
+
+    yield 'parse', parse
+    yield 'parse_untyped', parse_untyped
+    yield 'dates', dates
+    yield 'encode', lambda: (blood_app.encode_labels(df['BloodType'], blood_app.BLOOD_TYPES),
+                             blood_app.encode_labels(df['Diagnosis']))
+    yield 'groupby_blood_type', lambda: df.groupby('BloodType', observed=True)['LengthOfStay'].agg(['mean', 'count', 'median'])
+    yield 'groupby_diagnosis', lambda: df.groupby('Diagnosis', observed=True)['LengthOfStay'].agg(['mean', 'count'])
+    yield 'groupby_blood_diagnosis', lambda: df.groupby(['BloodType', 'Diagnosis'], observed=True)['LengthOfStay'].mean().unstack()
+    yield 'groupby_monthly', lambda: df.groupby(df['AdmissionDate'].dt.to_period('M')).size()
+    yield 'analyze', lambda: blood_app.analyze_data(df.copy())
+    yield 'aggregate', lambda: blood_app.StayAggregates().update(df)
+    yield 'chart_summary', lambda: blood_app.chart_summary(aggregates)
+    for name, (render, data, path) in blood_app.summary_chart_tasks(summary, 'benchmark').items():
+        yield f'chart_{name}', lambda render=render, data=data, path=path: render(data, path)
+    yield 'upload', upload
+
+def run(sizes, repeat, seed, folder):
+    blood_app.app.config['UPLOAD_FOLDER'] = folder
+    blood_app.app.config['CHART_WORKERS'] = 1
+    results = []
+    for rows in sizes:
+        csv_bytes = generate_patients(rows, seed).to_csv(index=False).encode()
+        for stage, fn in stages(csv_bytes, folder):
+            _, seconds, peak = measure(fn, repeat)
+            results.append({
+                'rows': rows,
+                'stage': stage,
+                'seconds': round(seconds, 6),
+                'rows_per_sec': int(rows / seconds) if seconds else None,
+                'peak_bytes': int(peak)
+            })
+            print(f'{rows:>10} {stage:<26} {seconds:10.4f}s {peak / 1e6:10.1f} MB', flush=True)
+    return results
+
+def probe():
+    blood_app.app.test_client().get('/')
+    blood_app.render_summary_pie_chart({'labels': blood_app.BLOOD_TYPES, 'counts': [1] * 8}, blood_app.ChartBuffer())
+
+def startup(repeat):
+    # Cold: a fresh interpreter imports the app, serves its first request and renders a chart.
+    # Warm: a child forked from a parent that already ran warm_up does the same.
+    cold = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        subprocess.run([sys.executable, '-c', 'import benchmark; benchmark.probe()'],
+                       cwd=os.path.dirname(os.path.abspath(__file__)), check=True)
+        cold.append(time.perf_counter() - started)
+    blood_app.warm_up()
+    warm = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        pid = os.fork()
+        if pid == 0:
+            probe()
+            os._exit(0)
+        os.waitpid(pid, 0)
+        warm.append(time.perf_counter() - started)
+    results = []
+    for stage, timings in (('startup_cold', cold), ('startup_warm', warm)):
+        results.append({'rows': None, 'stage': stage, 'seconds': round(min(timings), 6), 'rows_per_sec': None, 'peak_bytes': None})
+        print(f'{stage:<37} {min(timings):10.4f}s', flush=True)
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the blood type analysis pipeline on synthetic data.')
+    parser.add_argument('--sizes', type=int, nargs='+', default=DEFAULT_SIZES)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default='benchmark_results.json')
+    parser.add_argument('--generate', metavar='CSV', help='only write a synthetic dataset of --sizes[0] rows to CSV')
+    parser.add_argument('--startup', action='store_true', help='only measure cold and warm worker readiness')
+    args = parser.parse_args()
+
+    if args.generate:
+        generate_patients(args.sizes[0], args.seed).to_csv(args.generate, index=False)
+        return
+
+    if args.startup:
+        results = startup(args.repeat)
+    else:
+        with tempfile.TemporaryDirectory() as folder:
+            results = run(args.sizes, args.repeat, args.seed, folder)
+    with open(args.output, 'w') as f:
+        json.dump({
+            'meta': {
+                'timestamp': datetime.now().isoformat(timespec='seconds'),
+                'analysis_version': blood_app.ANALYSIS_VERSION,
+                'python': platform.python_version(),
+                'pandas': pd.__version__,
+                'numpy': np.__version__,
+                'cpu_count': os.cpu_count(),
+                'repeat': args.repeat,
+                'seed': args.seed
+            },
+            'results': results
+        }, f, indent=2)
+
+if __name__ == '__main__':
+    main()
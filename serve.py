@@ -0,0 +1,72 @@
+import argparse
+import importlib.util
+import os
+import tempfile
+
+import app as blood_app
+
+def configure(args):
+    blood_app.app.config['MAX_CONTENT_LENGTH'] = args.max_upload_mb * 1024 * 1024 if args.max_upload_mb else None
+    blood_app.app.config['MAX_CONCURRENT_REQUESTS'] = args.max_concurrent or None
+    blood_app.app.config['JOB_WORKERS'] = args.job_workers
+    blood_app.app.config['CHART_WORKERS'] = args.chart_workers
+    # Every worker process exports its stage metrics through this folder; /metrics sums them.
+    blood_app.app.config['METRICS_FOLDER'] = args.metrics_folder or tempfile.mkdtemp(prefix='blood_type_metrics_')
+    os.makedirs(blood_app.app.config['METRICS_FOLDER'], exist_ok=True)
+
+def serve_gunicorn(args):
+    from gunicorn.app.base import BaseApplication
+
+    class Application(BaseApplication):
+        def load_config(self):
+            self.cfg.set('bind', args.bind)
+            self.cfg.set('workers', args.workers)
+            self.cfg.set('threads', args.threads)
+            self.cfg.set('worker_class', 'gthread')
+            self.cfg.set('timeout', args.timeout)
+            self.cfg.set('preload_app', True)
+            self.cfg.set('max_requests', args.max_requests)
+            self.cfg.set('max_requests_jitter', args.max_requests // 10)
+
+        def load(self):
+            return blood_app.app
+
+    Application().run()
+
+def serve_werkzeug(args):
+    # Werkzeug's process mode forks a throwaway child per request, which loses every in-process cache,
+    # so without gunicorn the app runs as one threaded process.
+    from werkzeug.serving import run_simple
+    host, port = args.bind.rsplit(':', 1)
+    run_simple(host, int(port), blood_app.app, threaded=True)
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve the blood type analysis app with a pool of worker processes.')
+    parser.add_argument('--bind', default='127.0.0.1:8000')
+    parser.add_argument('--workers', type=int, help='worker processes (default: one per CPU with gunicorn, 1 without)')
+    parser.add_argument('--threads', type=int, default=4, help='request threads per worker (gunicorn only)')
+    parser.add_argument('--max-concurrent', type=int, default=0, help='requests in flight per worker before answering 503')
+    parser.add_argument('--max-upload-mb', type=int, default=512)
+    parser.add_argument('--timeout', type=int, default=300)
+    parser.add_argument('--max-requests', type=int, default=1000, help='recycle a worker after this many requests (gunicorn only)')
+    parser.add_argument('--job-workers', type=int, default=blood_app.app.config['JOB_WORKERS'])
+    parser.add_argument('--chart-workers', type=int, default=blood_app.app.config['CHART_WORKERS'])
+    parser.add_argument('--metrics-folder', help='shared folder for per-process metrics (default: a new temporary folder)')
+    parser.add_argument('--no-warm-up', dest='warm_up', action='store_false')
+    args = parser.parse_args()
+
+    has_gunicorn = importlib.util.find_spec('gunicorn') is not None
+    if args.workers is None:
+        args.workers = (os.cpu_count() or 1) if has_gunicorn else 1
+    if args.workers > 1 and not has_gunicorn:
+        parser.error('more than one worker needs gunicorn (pip install gunicorn)')
+    configure(args)
+    if args.warm_up:
+        blood_app.warm_up()
+    if has_gunicorn:
+        serve_gunicorn(args)
+    else:
+        serve_werkzeug(args)
+
+if __name__ == '__main__':
+    main()
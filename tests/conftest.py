@@ -0,0 +1,35 @@
+import os
+import sys
+import tempfile
+
+import pytest
+
+# app creates its upload and dataset folders relative to the working directory on import.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.chdir(tempfile.mkdtemp(prefix='blood_type_tests_'))
+
+import app as blood_app
+
+@pytest.fixture
+def app_config(tmp_path):
+    saved = dict(blood_app.app.config)
+    blood_app.app.config.update(
+        TESTING=True,
+        UPLOAD_FOLDER=str(tmp_path / 'uploads'),
+        JOB_FOLDER=str(tmp_path / 'jobs'),
+        DATASET_FOLDER=str(tmp_path / 'datasets'),
+        CHART_WORKERS=1
+    )
+    for key in ('UPLOAD_FOLDER', 'JOB_FOLDER', 'DATASET_FOLDER'):
+        os.makedirs(blood_app.app.config[key], exist_ok=True)
+    blood_app.result_cache.entries.clear()
+    blood_app.result_cache.size = 0
+    for cache in (blood_app._chart_summaries, blood_app._dataset_trends, blood_app._dataset_indexes):
+        cache.clear()
+    yield blood_app.app.config
+    blood_app.app.config.clear()
+    blood_app.app.config.update(saved)
+
+@pytest.fixture
+def client(app_config):
+    return blood_app.app.test_client()
@@ -0,0 +1,27 @@
+import io
+
+import app as blood_app
+
+CSV = b'''PatientID,BloodType,Diagnosis,AdmissionDate,DischargeDate
+1,A+,,2020-01-01,2020-01-11
+2,A+,Flu,2020-01-02,2020-01-06
+3,,Flu,2020-02-01,2020-02-03
+4,B+,Cold,2020-02-01,2020-02-03
+5,,,2020-02-01,2020-02-09
+6,O-,Cold,2020-03-04,
+'''
+
+def read():
+    return blood_app.read_patient_csv(io.BytesIO(CSV))
+
+def test_aggregates_match_analyze_data_with_missing_labels():
+    expected = blood_app.analyze_data(read())
+    assert expected['blood_type_stats']['count'] == {'A+': 2, 'B+': 1}
+    assert expected['diagnosis_stats']['count'] == {'Flu': 2, 'Cold': 1}
+    df = read()
+    aggregates = blood_app.StayAggregates().update(df.iloc[:3]).merge(blood_app.StayAggregates().update(df.iloc[3:]))
+    assert aggregates.results() == expected
+
+def test_stream_matches_analyze_data_with_missing_labels():
+    stream = blood_app.analyze_csv_stream(io.BytesIO(CSV), chunksize=2)
+    assert stream.results() == blood_app.analyze_data(read())
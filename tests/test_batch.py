@@ -0,0 +1,60 @@
+import io
+import zipfile
+
+import app as blood_app
+
+HEADER = 'PatientID,BloodType,Diagnosis,AdmissionDate,DischargeDate\n'
+NORTH = HEADER + '''N-1,A+,Flu,2020-01-01,2020-01-11
+N-2,B+,Flu,2020-01-02,2020-01-06
+N-3,O-,Cold,2020-02-01,2020-02-03
+'''
+SOUTH = HEADER + '''S-1,A+,Cold,2020-03-01,2020-03-02
+S-2,AB+,Flu,2020-03-04,2020-03-09
+'''
+
+def archive(members):
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED) as zf:
+        for name, data in members.items():
+            zf.writestr(name, data)
+    buffer.seek(0)
+    return buffer
+
+def post_batch(client, files, **fields):
+    return client.post('/upload/batch', data=dict(fields, files=files))
+
+def test_batch_reads_supported_members_of_a_zip(client):
+    files = [(archive({'sites/north.csv': NORTH, 'sites/.hidden.csv': 'junk', 'README.txt': 'notes',
+                       'sites/empty/': ''}), 'sites.zip'), (io.BytesIO(SOUTH.encode()), 'south.csv')]
+    body = post_batch(client, files, render='client', per_site='1').get_json()
+    assert body['files'] == 2
+    assert set(body['sites']) == {'north', 'south'}
+    assert body['sites']['north']['total_patients'] == 3
+    assert body['sites']['south']['total_patients'] == 2
+
+def test_batch_merge_matches_single_upload(client):
+    files = [(io.BytesIO(NORTH.encode()), 'north.csv'), (io.BytesIO(SOUTH.encode()), 'south.csv')]
+    merged = post_batch(client, files, render='client').get_json()
+    combined = (NORTH + SOUTH[len(HEADER):]).encode()
+    single = client.post('/upload', data={'file': (io.BytesIO(combined), 'all.csv'), 'render': 'client'}).get_json()
+    assert 'sites' not in merged
+    assert merged['analysis'] == single['analysis']
+
+def test_batch_names_repeated_sites_apart(client):
+    files = [(archive({'a/north.csv': NORTH, 'b/north.csv': NORTH}), 'sites.zip')]
+    body = post_batch(client, files, render='client', per_site='true').get_json()
+    assert list(body['sites']) == ['north', 'north (2)']
+    assert body['analysis']['total_patients'] == 6
+
+def test_batch_rejects_archives_expanding_past_the_limit(client, app_config):
+    app_config['BATCH_MAX_EXTRACTED_BYTES'] = 1024
+    files = [(archive({'north.csv': NORTH + 'N-4,A+,Flu,2020-01-01,2020-01-02\n' * 200}), 'sites.zip')]
+    response = post_batch(client, files)
+    assert response.status_code == 400
+    assert '1024 bytes' in response.get_json()['error']
+
+def test_batch_rejects_unsupported_files(client):
+    response = post_batch(client, [(io.BytesIO(b'notes'), 'notes.txt')])
+    assert response.status_code == 400
+    response = post_batch(client, [(archive({'notes.txt': 'notes'}), 'notes.zip')])
+    assert response.status_code == 400
@@ -0,0 +1,46 @@
+import threading
+import time
+
+import pytest
+
+import app as blood_app
+
+def test_dataset_cache_builds_each_key_once(app_config):
+    app_config['TEST_CACHE'] = 2
+    cache = blood_app.DatasetCache('TEST_CACHE')
+    builds = []
+
+    def build(key):
+        builds.append(key)
+        time.sleep(0.05)
+        return key
+
+    results = []
+    threads = [threading.Thread(target=lambda i=i: results.append(cache.get(i % 3, lambda: build(i % 3))))
+               for i in range(24)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert sorted(builds) == [0, 1, 2]
+    assert sorted(results) == sorted(i % 3 for i in range(24))
+    assert len(cache.entries) == 2
+
+def test_dataset_cache_evicts_by_weight(app_config):
+    app_config['TEST_CACHE'] = 10
+    cache = blood_app.DatasetCache('TEST_CACHE', weigh=len)
+    for key in 'abc':
+        cache.get(key, lambda key=key: key * 4)
+    assert list(cache.entries) == ['b', 'c']
+    cache.get('d', lambda: 'd' * 20)
+    assert list(cache.entries) == ['d']
+
+def test_dataset_cache_failed_build_is_retried(app_config):
+    app_config['TEST_CACHE'] = 2
+    cache = blood_app.DatasetCache('TEST_CACHE')
+
+    def fail():
+        raise blood_app.AnalysisError('broken')
+    with pytest.raises(blood_app.AnalysisError):
+        cache.get('key', fail)
+    assert cache.get('key', lambda: 'built') == 'built'
@@ -0,0 +1,63 @@
+import io
+import struct
+
+import pytest
+
+import app as blood_app
+
+CSV = b'''PatientID,BloodType,Diagnosis,AdmissionDate,DischargeDate
+P-1,A+,Flu,2020-01-01,2020-01-11
+P-2,B+,Flu,2020-01-02,2020-01-06
+P-3,O-,Cold,2020-02-01,2020-02-03
+'''
+
+SIGNATURES = {'png': b'\x89PNG', 'svg': b'<?xml', 'webp': b'RIFF'}
+
+@pytest.fixture
+def dataset_id(client):
+    response = client.post('/upload', data={'file': (io.BytesIO(CSV), 'patients.csv'), 'render': 'client'})
+    return response.get_json()['dataset_id']
+
+@pytest.mark.parametrize('storage', ['disk', 'memory'])
+@pytest.mark.parametrize('fmt', sorted(blood_app.CHART_FORMATS))
+def test_chart_formats(client, app_config, dataset_id, storage, fmt):
+    app_config['CHART_STORAGE'] = storage
+    for _ in range(2):
+        response = client.get(f'/charts/{dataset_id}/blood_type.{fmt}')
+        assert response.status_code == 200
+        assert response.mimetype == blood_app.CHART_FORMATS[fmt]
+        assert response.data.startswith(SIGNATURES[fmt])
+    if fmt == 'webp':
+        assert response.data[8:12] == b'WEBP'
+
+def test_chart_size_and_dpi(client, dataset_id):
+    response = client.get(f'/charts/{dataset_id}/pie.png?width=4&height=3&dpi=50')
+    assert response.status_code == 200
+    assert struct.unpack('>II', response.data[16:24]) == (200, 150)
+
+@pytest.mark.parametrize('query, message', [
+    ('width=4', 'given together'),
+    ('height=4', 'given together'),
+    ('width=0.5&height=4', 'between 1 and 40'),
+    ('width=4&height=41', 'between 1 and 40'),
+    ('width=nan&height=4', 'between 1 and 40'),
+    ('dpi=5', 'between 10 and 600'),
+    ('dpi=601', 'between 10 and 600'),
+])
+def test_chart_rejects_bad_dimensions(client, dataset_id, query, message):
+    response = client.get(f'/charts/{dataset_id}/histogram.png?{query}')
+    assert response.status_code == 400
+    assert message in response.get_json()['error']
+
+def test_chart_unknown_names(client, dataset_id):
+    assert client.get(f'/charts/{dataset_id}/scatter.png').status_code == 404
+    assert client.get(f'/charts/{dataset_id}/pie.gif').status_code == 404
+    assert client.get(f'/charts/{"0" * 64}/pie.png').status_code == 404
+
+def test_chart_render_failure_is_a_json_error(client, dataset_id, monkeypatch):
+    def failing(*args):
+        raise RuntimeError('renderer crashed')
+    monkeypatch.setattr(blood_app, 'dataset_chart_task', failing)
+    response = client.get(f'/charts/{dataset_id}/blood_diagnosis.svg')
+    assert response.status_code == 500
+    assert response.get_json() == {'error': 'renderer crashed'}
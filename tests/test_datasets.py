@@ -0,0 +1,127 @@
+import io
+import os
+
+import app as blood_app
+
+CSV = b'''PatientID,BloodType,Diagnosis,AdmissionDate,DischargeDate
+P-1,A+,Flu,2020-01-01,2020-01-11
+P-2,B+,Flu,2020-01-02,2020-01-06
+P-3,O-,Cold,2020-02-01,2020-02-03
+'''
+
+def upload(client, data=CSV, **fields):
+    response = client.post('/upload', data=dict(fields, file=(io.BytesIO(data), 'patients.csv')))
+    assert response.status_code == 200, response.get_json()
+    return response.get_json()
+
+def test_stored_upload_is_reloaded_without_patient_ids(client):
+    first = upload(client, render='client')
+    blood_app.result_cache.entries.clear()
+    blood_app.result_cache.size = 0
+    df = blood_app.load_frame(None, 'patients.csv', first['dataset_id'])
+    assert list(df.columns) == blood_app.ANALYSIS_COLUMNS
+    assert upload(client, render='client')['analysis'] == first['analysis']
+
+def batch_csv(ids):
+    rows = ''.join(f'{i},A+,Flu,2020-01-01,2020-01-0{2 + i % 5}\n' for i in ids)
+    return ('PatientID,BloodType,Diagnosis,AdmissionDate,DischargeDate\n' + rows).encode()
+
+def append(client, dataset_id, ids):
+    return client.post(f'/datasets/{dataset_id}/append', data={'file': (io.BytesIO(batch_csv(ids)), 'batch.csv')})
+
+def crash_on(monkeypatch, filename):
+    replace_file = blood_app.replace_file
+
+    def crashing(path, write):
+        if path.endswith(filename):
+            raise OSError('simulated crash')
+        return replace_file(path, write)
+    monkeypatch.setattr(blood_app, 'replace_file', crashing)
+
+def full_analysis(dataset_id):
+    return blood_app.analyze_data(blood_app.load_dataset(dataset_id, blood_app.ANALYSIS_COLUMNS))
+
+def test_append_skips_known_patients(client):
+    dataset_id = upload(client, batch_csv(range(10)), render='client')['dataset_id']
+    for start in range(5, 60, 5):
+        body = append(client, dataset_id, range(start, start + 10)).get_json()
+        assert (body['appended'], body['duplicates']) == (5, 5)
+    meta = blood_app.dataset_meta(dataset_id)
+    assert meta['rows'] == 65
+    assert len(meta['id_runs']) < 5
+    assert body['analysis'] == full_analysis(dataset_id)
+
+def test_append_matches_numeric_and_text_patient_ids(client):
+    dataset_id = upload(client, batch_csv([1, 2, 10]), render='client')['dataset_id']
+    batch = batch_csv([2, 10]) + b'P9,O-,Cold,2020-01-01,2020-01-03\n'
+    body = client.post(f'/datasets/{dataset_id}/append',
+                       data={'file': (io.BytesIO(batch), 'batch.csv')}).get_json()
+    assert (body['appended'], body['duplicates']) == (1, 2)
+
+def test_append_keeps_rows_without_patient_id(client):
+    data = batch_csv([1]) + b',B+,Flu,2020-01-01,2020-01-04\n'
+    dataset_id = upload(client, data, render='client')['dataset_id']
+    body = append(client, dataset_id, [1, 3]).get_json()
+    assert (body['appended'], body['duplicates']) == (1, 1)
+    assert body['analysis']['total_patients'] == 3
+
+def test_append_recovers_from_crash_before_commit(client, monkeypatch):
+    dataset_id = upload(client, batch_csv(range(10)), render='client')['dataset_id']
+    crash_on(monkeypatch, 'meta.json')
+    assert append(client, dataset_id, range(10, 20)).status_code == 500
+    monkeypatch.undo()
+    body = append(client, dataset_id, range(10, 20)).get_json()
+    assert (body['appended'], body['duplicates']) == (10, 0)
+    assert body['analysis'] == full_analysis(dataset_id)
+    assert body['analysis']['total_patients'] == 20
+
+def test_append_rebuilds_stale_aggregates_after_crash(client, monkeypatch):
+    dataset_id = upload(client, batch_csv(range(10)), render='client')['dataset_id']
+    assert append(client, dataset_id, range(10, 20)).status_code == 200
+    crash_on(monkeypatch, 'aggregates.pkl')
+    assert append(client, dataset_id, range(20, 30)).status_code == 500
+    monkeypatch.undo()
+    assert blood_app.dataset_aggregates(dataset_id).results() == full_analysis(dataset_id)
+    body = append(client, dataset_id, range(20, 40)).get_json()
+    assert (body['appended'], body['duplicates']) == (10, 10)
+    assert body['analysis'] == full_analysis(dataset_id)
+    assert body['analysis']['total_patients'] == 40
+
+def test_cached_lazy_charts_are_dropped_after_append(client):
+    first = upload(client, batch_csv(range(10)))
+    assert first['lazy_charts']
+    assert append(client, first['dataset_id'], range(10, 20)).status_code == 200
+    again = upload(client, batch_csv(range(10)))
+    assert 'lazy_charts' not in again
+    assert again['analysis'] == first['analysis']
+
+def test_artifact_index_is_not_served(client, app_config, tmp_path, monkeypatch):
+    monkeypatch.setattr(blood_app.app, 'static_folder', str(tmp_path / 'static'))
+    app_config['UPLOAD_FOLDER'] = str(tmp_path / 'static' / 'uploads')
+    os.makedirs(app_config['UPLOAD_FOLDER'])
+    # An index left behind by an earlier version is removed along with the new one being created.
+    open(os.path.join(app_config['UPLOAD_FOLDER'], '.artifacts.sqlite'), 'wb').close()
+    dataset_id = upload(client, batch_csv(range(10)), render='client')['dataset_id']
+    assert client.get(f'/charts/{dataset_id}/pie.png').status_code == 200
+    chart = os.listdir(os.path.join(app_config['UPLOAD_FOLDER'], 'charts', dataset_id))[0]
+    assert client.get(f'/static/uploads/charts/{dataset_id}/{chart}').status_code == 200
+    assert os.path.exists(os.path.join(app_config['DATASET_FOLDER'], '.artifacts.sqlite'))
+    assert client.get('/static/uploads/.artifacts.sqlite').status_code == 404
+    assert not os.path.exists('artifacts.sqlite')
+
+def test_datasets_are_evicted_by_size_and_age(client, app_config):
+    first = upload(client, batch_csv(range(10)), render='client')['dataset_id']
+    second = upload(client, batch_csv(range(20)), render='client')['dataset_id']
+    assert blood_app.dataset_meta(first) and blood_app.dataset_meta(second)
+    app_config['DATASET_MAX_BYTES'] = blood_app.dataset_size(second) + blood_app.dataset_size(first) * 3 // 2
+    os.utime(blood_app.dataset_path(first, 'meta.json'), (1, 1))
+    third = upload(client, batch_csv(range(5)), render='client')['dataset_id']
+    assert blood_app.dataset_meta(first) is None
+    assert blood_app.dataset_meta(third) is not None
+    assert client.get(f'/datasets/{first}/trend').status_code == 404
+
+    app_config['DATASET_MAX_BYTES'] = 1 << 40
+    os.utime(blood_app.dataset_path(second, 'meta.json'), (1, 1))
+    assert append(client, third, range(5, 8)).status_code == 200
+    assert blood_app.dataset_meta(second) is None
+    assert blood_app.dataset_meta(third) is not None
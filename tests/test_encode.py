@@ -0,0 +1,20 @@
+import time
+
+import numpy as np
+import pandas as pd
+
+import app as blood_app
+
+def test_encode_labels_keeps_fixed_levels_first_and_missing_last():
+    codes, levels = blood_app.encode_labels(pd.Series(['O-', 'A+', None, 'Zz']), blood_app.BLOOD_TYPES)
+    assert levels == blood_app.BLOOD_TYPES + ['Zz']
+    assert codes.tolist() == [7, 0, 9, 8]
+
+def test_encode_labels_scales_with_many_labels():
+    labels = np.array([f'Condition {i:05d}' for i in range(30000)], dtype=object)
+    values = pd.Series(np.random.default_rng(0).choice(labels, 100000))
+    started = time.perf_counter()
+    codes, levels = blood_app.encode_labels(values)
+    assert time.perf_counter() - started < 2
+    assert codes.dtype == np.int32
+    assert (np.array(levels, dtype=object)[codes] == values.to_numpy()).all()
@@ -0,0 +1,86 @@
+import io
+from datetime import datetime
+
+import pytest
+from openpyxl import Workbook
+
+import app as blood_app
+
+CSV = '''PatientID,BloodType,Diagnosis,AdmissionDate,DischargeDate
+1,A+,Flu,2020-01-01,2020-01-11
+2,B+,Flu,2020-01-02,2020-01-06
+P-3,O-,Cold,2020-02-01,2020-02-03
+4,AB-,Cold,2020-02-05,
+'''
+
+def rows(csv):
+    lines = [line.split(',') for line in csv.strip().split('\n')[1:]]
+    for patient_id, blood_type, diagnosis, admitted, discharged in lines:
+        yield (int(patient_id) if patient_id.isdigit() else patient_id, blood_type, diagnosis,
+               datetime.strptime(admitted, '%Y-%m-%d'), datetime.strptime(discharged, '%Y-%m-%d') if discharged else None)
+
+def workbook(columns=blood_app.REQUIRED_COLUMNS):
+    wb = Workbook()
+    north = wb.active
+    north.title = 'North'
+    # An unused column between the required ones, which the column reader has to skip.
+    north.append(['Ward'] + columns[:2] + ['Notes'] + columns[2:])
+    for row in rows(CSV):
+        north.append(['W1'] + list(row[:2]) + ['-'] + list(row[2:]))
+    south = wb.create_sheet('South')
+    south.append(columns)
+    south.append([9, 'O+', 'Flu', datetime(2021, 5, 1), datetime(2021, 5, 3)])
+    buffer = io.BytesIO()
+    wb.save(buffer)
+    buffer.seek(0)
+    return buffer
+
+def read_csv():
+    return blood_app.read_patient_csv(io.BytesIO(CSV.encode()))
+
+def test_column_reader_matches_csv():
+    df = blood_app.read_patient_excel(workbook(), 'patients.xlsx', engine='openpyxl')
+    assert df.attrs['ingest']['engine'] == 'openpyxl'
+    expected = read_csv()
+    assert list(df['PatientID']) == list(expected['PatientID']) == ['1', '2', 'P-3', '4']
+    assert blood_app.analyze_data(df) == blood_app.analyze_data(expected)
+
+def test_pandas_reader_matches_column_reader(monkeypatch):
+    expected = blood_app.read_patient_excel(workbook(), 'patients.xlsx', engine='openpyxl')
+    monkeypatch.setattr(blood_app, 'openpyxl', None)
+    df = blood_app.read_patient_excel(workbook(), 'patients.xlsx', engine='openpyxl')
+    assert df.attrs['ingest']['engine'] == 'excel'
+    assert list(df['PatientID']) == list(expected['PatientID'])
+    assert blood_app.analyze_data(df) == blood_app.analyze_data(expected)
+
+@pytest.mark.parametrize('sheet', ['South', '1', 1])
+def test_sheet_selection(sheet):
+    df = blood_app.read_patient_excel(workbook(), 'patients.xlsx', sheet=sheet, engine='openpyxl')
+    assert list(df['PatientID']) == ['9']
+
+@pytest.mark.parametrize('sheet', ['West', '5'])
+def test_missing_sheet_is_reported(sheet):
+    with pytest.raises(blood_app.AnalysisError, match='Worksheet not found'):
+        blood_app.read_patient_excel(workbook(), 'patients.xlsx', sheet=sheet, engine='openpyxl')
+
+def test_missing_column_is_reported():
+    columns = [col for col in blood_app.REQUIRED_COLUMNS if col != 'Diagnosis'] + ['Diagnosis code']
+    with pytest.raises(blood_app.AnalysisError, match='Missing required columns'):
+        blood_app.read_patient_excel(workbook(columns), 'patients.xlsx', engine='openpyxl')
+
+def test_each_sheet_is_stored_as_its_own_dataset(client):
+    # openpyxl stamps the save time into the workbook, so it is built once for all uploads.
+    data = workbook().getvalue()
+
+    def upload(**fields):
+        return client.post('/upload', data=dict(fields, file=(io.BytesIO(data), 'patients.xlsx'), render='client'))
+    first = upload().get_json()
+    named = upload(sheet='North').get_json()
+    south = upload(sheet='South').get_json()
+    assert first['dataset_id'] == blood_app.file_digest(io.BytesIO(data))
+    assert south['dataset_id'] not in (first['dataset_id'], named['dataset_id'])
+    assert first['analysis'] == named['analysis']
+    assert south['analysis']['total_patients'] == 1
+    response = upload(sheet='West')
+    assert response.status_code == 400
+    assert 'Worksheet not found' in response.get_json()['error']
@@ -0,0 +1,59 @@
+import io
+import threading
+import time
+from concurrent.futures import Future
+
+import app as blood_app
+
+CSV = b'''PatientID,BloodType,Diagnosis,AdmissionDate,DischargeDate
+1,A+,Flu,2020-01-01,2020-01-11
+2,B+,Flu,2020-01-02,2020-01-06
+3,O-,Cold,2020-02-01,2020-02-03
+'''
+
+def done_future():
+    future = Future()
+    future.set_result(None)
+    return future
+
+def test_async_upload_runs_as_job(client):
+    response = client.post('/upload', data={'file': (io.BytesIO(CSV), 'jobs.csv'), 'async': '1', 'render': 'client'})
+    assert response.status_code == 202
+    job_id = response.get_json()['job_id']
+    # Another worker process has none of this one's futures; it answers from the job record alone.
+    with blood_app.jobs_lock:
+        blood_app.jobs.clear()
+    for _ in range(200):
+        response = client.get(f'/jobs/{job_id}/result')
+        if response.status_code != 202:
+            break
+        time.sleep(0.05)
+    assert response.status_code == 200
+    assert response.get_json()['analysis']['total_patients'] == 3
+
+def test_job_history_is_safe_under_concurrent_submits(app_config):
+    app_config['JOB_HISTORY'] = 5
+    errors = []
+
+    def add(worker):
+        try:
+            for i in range(500):
+                with blood_app.jobs_lock:
+                    blood_app.add_job(f'{worker}-{i}', {'future': done_future(), 'created': time.time()})
+                    sum(1 for job in blood_app.jobs.values() if not blood_app.job_done(job))
+                with blood_app.jobs_lock:
+                    blood_app.jobs.get(f'{worker}-{i}')
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=add, args=(worker,)) for worker in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert not errors
+    assert len(blood_app.jobs) <= 5
+
+def test_unknown_and_malformed_job_ids(client):
+    assert client.get('/jobs/' + '0' * 32).status_code == 404
+    assert client.get('/jobs/..%2Fetc').status_code == 404
@@ -0,0 +1,53 @@
+import io
+
+import pytest
+
+import app as blood_app
+
+CSV = b'''PatientID,BloodType,Diagnosis,AdmissionDate,DischargeDate
+1,A+,Flu,2020-01-01,2020-01-11
+2,O-,Flu,2020-01-02,2020-01-06
+3,AB+,Cold,2020-02-01,2020-02-03
+4,O-,Cold,2020-03-01,2020-03-04
+'''
+
+@pytest.fixture
+def dataset_id(client):
+    return client.post('/upload', data={'file': (io.BytesIO(CSV), 'query.csv'), 'render': 'client'}).get_json()['dataset_id']
+
+def test_query_matches_filtered_analysis(client, dataset_id):
+    response = client.post(f'/datasets/{dataset_id}/query', json={'blood_type': ['O-', 'AB+'], 'start': '2020-01-15'})
+    assert response.status_code == 200
+    body = response.get_json()
+    assert body['rows'] == 2
+    df = blood_app.read_patient_csv(io.BytesIO(CSV))
+    assert body['analysis'] == blood_app.analyze_data(df.iloc[[2, 3]].reset_index(drop=True))
+    response = client.get(f'/datasets/{dataset_id}/query?rh=negative&diagnosis=Flu')
+    assert response.get_json()['rows'] == 1
+
+@pytest.mark.parametrize('body', [{'blood_type': None}, {'diagnosis': [1]}, {'rh': ['negative']}, {'start': 20200101}, ['O-']])
+def test_query_rejects_malformed_filters(client, dataset_id, body):
+    response = client.post(f'/datasets/{dataset_id}/query', json=body)
+    assert response.status_code == 400
+    assert 'error' in response.get_json()
+
+def test_query_rejects_invalid_json(client, dataset_id):
+    response = client.post(f'/datasets/{dataset_id}/query', data='{', content_type='application/json')
+    assert response.status_code == 400
+
+def test_query_without_known_stays_has_no_analysis(client):
+    data = CSV + b'5,B-,Gout,2020-04-01,\n6,B-,Gout,2020-04-02,\n'
+    dataset_id = client.post('/upload', data={'file': (io.BytesIO(data), 'query.csv'), 'render': 'client'}).get_json()['dataset_id']
+    body = client.get(f'/datasets/{dataset_id}/query?diagnosis=Gout').get_json()
+    assert (body['rows'], body['analysis']) == (2, None)
+    body = client.get(f'/datasets/{dataset_id}/query?blood_type=A%2B&diagnosis=Gout').get_json()
+    assert (body['rows'], body['analysis']) == (0, None)
+
+def test_query_indexes_are_budgeted_by_size(client, app_config, dataset_id):
+    index = blood_app.dataset_index(dataset_id, 0)
+    assert index.nbytes >= index.df.memory_usage(deep=True).sum()
+    other = client.post('/upload', data={'file': (io.BytesIO(CSV + b'5,B-,Flu,2020-04-01,2020-04-02\n'), 'other.csv'),
+                                         'render': 'client'}).get_json()['dataset_id']
+    app_config['QUERY_INDEX_CACHE_BYTES'] = index.nbytes * 3 // 2
+    blood_app.dataset_index(other, 0)
+    assert list(blood_app._dataset_indexes.entries) == [(other, 0)]
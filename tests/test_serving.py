@@ -0,0 +1,43 @@
+import io
+import os
+
+import pytest
+
+import app as blood_app
+
+def test_metrics_include_forked_processes(client, app_config, tmp_path):
+    app_config['METRICS_FOLDER'] = str(tmp_path / 'metrics')
+    os.makedirs(app_config['METRICS_FOLDER'])
+    blood_app.stage_metrics.observe('test.parent', 0.001)
+    pid = os.fork()
+    if pid == 0:
+        blood_app.stage_metrics.observe('test.child', 0.001)
+        blood_app.stage_metrics.observe('test.parent', 0.001)
+        blood_app.stage_metrics.flush()
+        os._exit(0)
+    os.waitpid(pid, 0)
+    body = client.get('/metrics').get_data(as_text=True)
+    assert 'blood_type_stage_seconds_count{stage="test.child"} 1' in body
+    assert 'blood_type_stage_seconds_count{stage="test.parent"} 2' in body
+    assert 'test.child' not in blood_app.stage_metrics.snapshot()
+
+def test_serve_refuses_several_workers_without_gunicorn(monkeypatch):
+    import serve
+    monkeypatch.setattr(serve.importlib.util, 'find_spec', lambda name: None)
+    monkeypatch.setattr('sys.argv', ['serve.py', '--workers', '2', '--no-warm-up'])
+    with pytest.raises(SystemExit):
+        serve.main()
+
+CSV = b'PatientID,BloodType,Diagnosis,AdmissionDate,DischargeDate\n1,A+,Flu,2020-01-01,2020-01-03\n'
+
+def test_oversized_form_field_reports_form_limit(client, app_config):
+    app_config['MAX_CONTENT_LENGTH'] = None
+    response = client.post('/upload', data={'mode': 'x' * 600_000, 'file': (io.BytesIO(CSV), 'patients.csv')})
+    assert response.status_code == 413
+    assert 'Form data' in response.get_json()['error']
+
+def test_oversized_upload_reports_upload_limit(client, app_config):
+    app_config['MAX_CONTENT_LENGTH'] = 1024
+    response = client.post('/upload', data={'file': (io.BytesIO(CSV * 100), 'patients.csv')})
+    assert response.status_code == 413
+    assert 'Upload exceeds' in response.get_json()['error']
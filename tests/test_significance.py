@@ -0,0 +1,50 @@
+import io
+
+import numpy as np
+import pytest
+
+import app as blood_app
+
+stats = pytest.importorskip('scipy.stats')
+
+def histograms(samples):
+    values = np.unique(np.concatenate(samples))
+    return values, np.array([np.bincount(np.searchsorted(values, sample), minlength=len(values)) for sample in samples])
+
+def stay_samples(seed=0):
+    rng = np.random.default_rng(seed)
+    return [rng.poisson(lam, size) for lam, size in ((4, 120), (5, 90), (4.5, 60), (6, 30))]
+
+def test_kruskal_wallis_matches_scipy():
+    samples = stay_samples()
+    _, counts = histograms(samples)
+    h, df, p = blood_app.kruskal_wallis(counts)
+    expected = stats.kruskal(*samples)
+    assert h == pytest.approx(expected.statistic)
+    assert df == len(samples) - 1
+    assert p == pytest.approx(expected.pvalue)
+
+def test_mann_whitney_matches_scipy():
+    samples = stay_samples(1)
+    _, counts = histograms(samples[:2])
+    u, p = blood_app.mann_whitney(counts[0], counts[1])
+    expected = stats.mannwhitneyu(samples[0], samples[1], alternative='two-sided', use_continuity=True, method='asymptotic')
+    assert u == pytest.approx(expected.statistic)
+    assert p == pytest.approx(expected.pvalue)
+
+def test_bootstrap_intervals_match_scipy():
+    samples = stay_samples(2)[:2]
+    values, counts = histograms(samples)
+    mean_ci, median_ci = blood_app.bootstrap_intervals(values, counts, resamples=4000, confidence=0.95, seed=0, threads=2)
+    for k, sample in enumerate(samples):
+        for ci, statistic in ((mean_ci, np.mean), (median_ci, np.median)):
+            expected = stats.bootstrap((sample,), statistic, n_resamples=4000, confidence_level=0.95,
+                                       method='percentile', random_state=0).confidence_interval
+            assert ci[k] == pytest.approx([expected.low, expected.high], abs=0.3)
+
+def test_significance_rejects_negative_seed(client):
+    csv = b'PatientID,BloodType,Diagnosis,AdmissionDate,DischargeDate\n1,A+,Flu,2020-01-01,2020-01-03\n'
+    dataset_id = client.post('/upload', data={'file': (io.BytesIO(csv), 'seed.csv'), 'render': 'client'}).get_json()['dataset_id']
+    response = client.get(f'/datasets/{dataset_id}/significance?seed=-1')
+    assert response.status_code == 400
+    assert client.get(f'/datasets/{dataset_id}/significance?seed=3&resamples=10').status_code == 200
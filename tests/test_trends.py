@@ -0,0 +1,82 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+import app as blood_app
+
+ROWS = [
+    ('A+', 'Flu', '2020-01-01', '2020-01-11'),
+    ('B+', 'Flu', '2020-01-02', '2020-01-06'),
+    ('A+', 'Cold', '2020-02-01', '2020-02-03'),
+    ('O-', 'Cold', '2020-04-15', None),
+]
+
+def frame(rows):
+    return pd.DataFrame({
+        'BloodType': pd.Categorical([row[0] for row in rows]),
+        'Diagnosis': pd.Categorical([row[1] for row in rows]),
+        'AdmissionDate': pd.to_datetime([row[2] for row in rows]),
+        'DischargeDate': pd.to_datetime([row[3] for row in rows])
+    })
+
+@pytest.fixture
+def cube():
+    return blood_app.TrendCube(frame(ROWS))
+
+def day(text):
+    return np.datetime64(text, 'D')
+
+def test_quarter_buckets(cube):
+    trend = cube.query('quarter')
+    assert trend['buckets'] == ['2020-Q1', '2020-Q2']
+    assert trend['series'] == {'all': {'admissions': [3, 1], 'avg_stay': [5.33, None]}}
+
+def test_week_buckets_include_empty_weeks(cube):
+    trend = cube.query('week', end=day('2020-02-05'))
+    assert trend['buckets'] == ['2019-12-30', '2020-01-06', '2020-01-13', '2020-01-20', '2020-01-27', '2020-02-03']
+    assert trend['series']['all']['admissions'] == [2, 0, 0, 0, 1, 0]
+    assert trend['series']['all']['avg_stay'] == [7.0, None, None, None, 2.0, None]
+
+def test_by_blood_type_with_filters(cube):
+    trend = cube.query('month', blood_types=['A+', 'B+'], diagnoses=['Flu'], by='blood_type')
+    assert trend['buckets'] == ['2020-01', '2020-02', '2020-03', '2020-04']
+    assert trend['series'] == {
+        'A+': {'admissions': [1, 0, 0, 0], 'avg_stay': [10.0, None, None, None]},
+        'B+': {'admissions': [1, 0, 0, 0], 'avg_stay': [4.0, None, None, None]}
+    }
+
+def test_by_diagnosis(cube):
+    trend = cube.query('month', by='diagnosis')
+    assert trend['series']['Cold']['admissions'] == [0, 1, 0, 1]
+    assert trend['series']['Flu']['admissions'] == [2, 0, 0, 0]
+    assert trend['series']['Cold']['avg_stay'] == [None, 2.0, None, None]
+    filtered = cube.query('month', blood_types=['A+'], by='diagnosis')
+    assert filtered['series']['Cold']['admissions'] == [0, 1, 0, 0]
+
+def test_start_and_end_are_clipped_to_the_data(cube):
+    trend = cube.query('day', start=day('2019-06-01'), end=day('2020-01-02'))
+    assert (trend['start'], trend['end']) == ('2020-01-01', '2020-01-02')
+    assert trend['series']['all']['admissions'] == [1, 1]
+    trend = cube.query('month', start=day('2020-01-15'), end=day('2021-01-01'))
+    assert (trend['start'], trend['end']) == ('2020-01-15', '2020-04-15')
+    assert trend['series']['all']['admissions'] == [0, 1, 0, 1]
+    for start, end in ((day('2020-03-01'), day('2020-02-01')), (day('2021-01-01'), None)):
+        trend = cube.query('month', start=start, end=end)
+        assert (trend['start'], trend['buckets'], trend['series']['all']['admissions']) == (None, [], [])
+
+def test_invalid_queries(cube):
+    with pytest.raises(blood_app.AnalysisError):
+        cube.query('year')
+    with pytest.raises(blood_app.AnalysisError):
+        cube.query(by='ward')
+    with pytest.raises(blood_app.AnalysisError, match='Unknown diagnosis: Gout'):
+        cube.query(diagnoses=['Gout'])
+
+def test_stray_dates_do_not_widen_the_cube(cube):
+    stray = blood_app.TrendCube(frame(ROWS + [('A+', 'Flu', '1900-01-01', '1900-01-04')]))
+    assert stray.days == cube.days + 1
+    assert stray.nbytes < 2 * cube.nbytes
+    trend = stray.query('quarter', start=day('2020-01-01'))
+    assert trend['series'] == cube.query('quarter')['series']
+    buckets = stray.query('quarter')['buckets']
+    assert (buckets[0], buckets[-1], len(buckets)) == ('1900-Q1', '2020-Q2', 120 * 4 + 2)